@@ -0,0 +1,173 @@
+#!/usr/bin/env python3
+
+"""Generates many sets of puzzles described in a manifest file.
+
+The manifest is JSON, TOML or YAML (if PyYAML is installed) with a list
+of jobs. Every job has a type, mastermind or sudoku, and the options of
+that generator with - replaced by _:
+
+{"jobs": [
+  {"name": "patrol-a", "type": "mastermind", "sheets": 10, "easy": 4,
+   "filename": "patrol-a.xlsx", "seed": 1},
+  {"name": "camp", "type": "sudoku", "sheets": 40, "stops": 13,
+   "filename": "camp.xlsx"}
+]}
+
+A job without a filename is saved in <name>.xlsx. The files of the jobs
+are put in --output-directory and no two jobs may write the same file.
+
+The jobs are run by a pool of worker processes. Tables that do not
+depend on the job, like the feedback index used by --minimal, are kept
+by each worker between its jobs.
+"""
+
+import argparse
+import concurrent.futures
+import contextlib
+import json
+import os
+import sys
+import time
+import tomllib
+
+import mastermind_puzzlegenerator
+import sudoku_puzzlegenerator
+
+
+GENERATORS = {
+    "mastermind": mastermind_puzzlegenerator,
+    "sudoku": sudoku_puzzlegenerator,
+}
+
+FILE_OPTIONS = ("filename", "shard_directory", "state")
+
+
+parser = argparse.ArgumentParser(
+    description="Generate many sets of puzzles from a manifest.")
+parser.add_argument('manifest', type=str,
+                    help='The JSON, TOML or YAML file with the jobs')
+parser.add_argument('--workers', type=int, default=os.cpu_count(),
+                    help='Number of jobs run at the same time')
+parser.add_argument('--output-directory', type=str, default=".",
+                    help='Directory for the files of the jobs that are not '
+                    'given with absolute paths')
+parser.add_argument('--summary', type=str,
+                    help='File where a JSON summary of the jobs is stored')
+parser.add_argument('--verbose', '-v', action='store_true',
+                    help='Show the output of the generators',
+                    default=False)
+
+
+def read_manifest(filename):
+    """Returns the list of jobs in the manifest."""
+    if filename.endswith(".toml"):
+        with open(filename, "rb") as f:
+            manifest = tomllib.load(f)
+    elif filename.endswith((".yaml", ".yml")):
+        import yaml
+        with open(filename) as f:
+            manifest = yaml.safe_load(f)
+    else:
+        with open(filename) as f:
+            manifest = json.load(f)
+    jobs = manifest["jobs"]
+    for n, job in enumerate(jobs, start=1):
+        if job.get("type") not in GENERATORS:
+            raise ValueError(f"Job {n} has unknown type {job.get('type')}")
+        job.setdefault("name", f"{job['type']}-{n}")
+    return jobs
+
+
+def job_arguments(job, output_directory):
+    """Translate a job to command line arguments for its generator.
+
+    A job without a filename is saved in <name>.xlsx."""
+    job = dict(job)
+    job.setdefault("filename", job["name"] + ".xlsx")
+    argv = []
+    for key, value in job.items():
+        if key in ("name", "type"):
+            continue
+        if key in FILE_OPTIONS:
+            value = os.path.join(output_directory, value)
+        option = "--" + key.replace("_", "-")
+        if value is True:
+            argv.append(option)
+        elif value is not False and value is not None:
+            argv.extend([option, str(value)])
+    return argv
+
+
+def run_job(job, output_directory, verbose):
+    """Run one job. Returns a dict summarizing it."""
+    argv = job_arguments(job, output_directory)
+    started = time.perf_counter()
+    result = {"name": job["name"], "type": job["type"], "arguments": argv}
+    try:
+        with open(os.devnull, "w") as devnull:
+            output = sys.stdout if verbose else devnull
+            with contextlib.redirect_stdout(output):
+                GENERATORS[job["type"]].main(argv)
+        result["status"] = "ok"
+    except (Exception, SystemExit) as e:
+        # argparse exits on a bad option in the job.
+        result["status"] = f"failed: {e!r}"
+    result["seconds"] = round(time.perf_counter() - started, 3)
+    return result
+
+
+def check_files(jobs, output_directory):
+    """Raise ValueError if two jobs write the same file or directory."""
+    written = dict()
+    for job in jobs:
+        argv = job_arguments(job, output_directory)
+        for key in FILE_OPTIONS:
+            option = "--" + key.replace("_", "-")
+            if option not in argv:
+                continue
+            path = os.path.abspath(argv[argv.index(option) + 1])
+            if path in written:
+                raise ValueError(f"Jobs {written[path]} and {job['name']} "
+                                 f"both write {path}")
+            written[path] = job["name"]
+
+
+def run_jobs(jobs, workers, output_directory, verbose):
+    """Run the jobs on workers processes.
+
+    Returns the summaries in the order of the jobs."""
+    check_files(jobs, output_directory)
+    os.makedirs(output_directory, exist_ok=True)
+    if workers <= 1:
+        return [run_job(job, output_directory, verbose) for job in jobs]
+    with concurrent.futures.ProcessPoolExecutor(workers) as executor:
+        futures = [executor.submit(run_job, job, output_directory, verbose)
+                   for job in jobs]
+        return [future.result() for future in futures]
+
+
+def main(argv=None):
+    args = parser.parse_args(argv)
+
+    jobs = read_manifest(args.manifest)
+    started = time.perf_counter()
+    results = run_jobs(jobs, args.workers, args.output_directory,
+                       args.verbose)
+    seconds = time.perf_counter() - started
+
+    for result in results:
+        print(f"{result['name']:<20} {result['type']:<10} "
+              f"{result['seconds']:>8.2f}s {result['status']}")
+    failed = [r for r in results if r["status"] != "ok"]
+    print(len(results), "jobs,", len(failed), "failed, in",
+          round(seconds, 2), "seconds")
+
+    if args.summary:
+        with open(args.summary, "w") as f:
+            json.dump({"seconds": round(seconds, 3), "jobs": results},
+                      f, indent=2)
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
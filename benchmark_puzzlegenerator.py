@@ -0,0 +1,226 @@
+#!/usr/bin/env python3
+
+"""Measures the time of each phase of generating mastermind and sudoku
+sets for a grid of configurations.
+
+Every configuration is run with a fixed seed so that the same work is
+measured every time. The results are appended to a history file with one
+JSON object per line and compared to a stored baseline.
+
+Store a baseline:
+--save-baseline
+
+Compare to it:
+(no options)
+"""
+
+import argparse
+import io
+import itertools
+import json
+import platform
+import random
+import sys
+import time
+
+import mastermind_puzzlegenerator as mastermind
+import sudoku_puzzlegenerator as sudoku
+
+
+parser = argparse.ArgumentParser(
+    description="Benchmark the generation and rendering of puzzles.")
+parser.add_argument('--quick', action='store_true',
+                    help='Run a smaller grid of configurations',
+                    default=False)
+parser.add_argument('--repeat', type=int, default=3,
+                    help='Number of runs of each configuration. '
+                    'The fastest is kept')
+parser.add_argument('--seed', type=int, default=4711,
+                    help='Seed used for every configuration')
+parser.add_argument('--history', type=str,
+                    help='File where the results are appended',
+                    default="benchmark_history.jsonl")
+parser.add_argument('--baseline', type=str,
+                    help='File with the results to compare to',
+                    default="benchmark_baseline.json")
+parser.add_argument('--save-baseline', action='store_true',
+                    help='Store the results as the new baseline',
+                    default=False)
+parser.add_argument('--tolerance', type=float, default=0.25,
+                    help='How much slower than the baseline a phase can be '
+                    'before it is a regression')
+parser.add_argument('--render', action=argparse.BooleanOptionalAction,
+                    help='Also measure writing the workbooks',
+                    default=True)
+
+
+def mastermind_configurations(quick):
+    """Generate (name, args) for the mastermind grid."""
+    sheets = 4 if quick else 10
+    for columns, colors, stops, easy in itertools.product(
+            (3, 4),
+            (6,) if quick else (6, 8),
+            (10,) if quick else (10, 15),
+            (False, True)):
+        args = mastermind.parser.parse_args(
+            ['--sheets', str(sheets),
+             '--easy', str(sheets // 2 if easy else 0),
+             '--columns', str(columns),
+             '--colors', str(colors),
+             '--stops', str(stops)])
+        name = (f"mastermind columns={columns} colors={colors} "
+                f"stops={stops} easy={args.easy}")
+        yield name, args
+
+
+def sudoku_configurations(quick):
+    """Generate (name, args) for the sudoku grid."""
+    for sheets, initial_values, stops in itertools.product(
+            (5,) if quick else (10, 50),
+            (15, 30),
+            (8,) if quick else (8, 13)):
+        args = sudoku.parser.parse_args(
+            ['--sheets', str(sheets),
+             '--initial-values', str(initial_values),
+             '--stops', str(stops)])
+        name = (f"sudoku sheets={sheets} initial-values={initial_values} "
+                f"stops={stops}")
+        yield name, args
+
+
+class Timer(object):
+    """Collects the time of the phases."""
+
+    def __init__(self):
+        self.phases = dict()
+        self._last = time.perf_counter()
+
+    def phase(self, name):
+        """End the phase with the given name."""
+        now = time.perf_counter()
+        self.phases[name] = now - self._last
+        self._last = now
+
+
+def run_mastermind(args, render, rng):
+    config = mastermind.MastermindConfig.from_args(args)
+    timer = Timer()
+    stops = mastermind.Stops(config, rng)
+    sheets = list(mastermind.generate_sheets(config, 1, 1, rng))
+    timer.phase("generate")
+    stops.add_answers(mastermind.answer_matrix(config,
+                                               [s.correct for s in sheets],
+                                               [s.clue_lines for s in sheets]))
+    timer.phase("answers")
+    if render:
+        mastermind.load_openpyxl()
+        wb = mastermind.openpyxl.Workbook()
+        ws = wb.active
+        row = 1
+        correct_lines = dict()
+        for sheet_number, s in enumerate(sheets, start=1):
+            correct_lines[sheet_number] = (s.correct, s.solvable)
+            s.output(ws, str(sheet_number), row, stops)
+            row += mastermind.ROWS_PER_SHEET
+        row = mastermind.output_correct_answers(ws, config, correct_lines,
+                                                row)
+        stops.output(ws, row)
+        timer.phase("render")
+        wb.save(io.BytesIO())
+        timer.phase("save")
+    return timer.phases
+
+
+def run_sudoku(args, render, rng):
+    timer = Timer()
+    gen = sudoku.SudokuGenerator(sudoku.SudokuConfig.from_args(args), rng)
+    gen.generate_sheets()
+    timer.phase("generate")
+    gen.allocate_replacements_to_stops()
+    timer.phase("allocate")
+    if render:
+        sudoku.load_openpyxl()
+        wb = sudoku.openpyxl.Workbook()
+        ws = wb.active
+        replacement = gen.replacement.move_stops(
+            {x: x + 1 for x in range(args.stops)})
+        start_row = 1
+        for n, s in enumerate(gen.sheets):
+            s.output(ws, sudoku.HEADING_PER_SHEET + " " + str(1 + n),
+                     start_row, replacement)
+            start_row = start_row + sudoku.ROWS_PER_SHEET
+        for n, s in enumerate(gen.stops):
+            gen.output_stop(ws, s, n + 1,
+                            sudoku.HEADING_PER_STOP + " " + str(n + 1),
+                            start_row)
+            start_row = start_row + sudoku.ROWS_PER_SHEET
+        timer.phase("render")
+        wb.save(io.BytesIO())
+        timer.phase("save")
+    return timer.phases
+
+
+def run(configurations, runner, args):
+    """Run every configuration args.repeat times.
+
+    Returns a dict name => phase => fastest time in seconds."""
+    results = dict()
+    for name, configuration in configurations:
+        fastest = dict()
+        for _ in range(args.repeat):
+            rng = random.Random(args.seed)
+            for phase, seconds in runner(configuration, args.render,
+                                         rng).items():
+                fastest[phase] = min(seconds, fastest.get(phase, seconds))
+        results[name] = fastest
+        print(name, " ".join(f"{phase}={seconds:.4f}"
+                             for phase, seconds in fastest.items()))
+    return results
+
+
+def regressions(results, baseline, tolerance):
+    """Generate (name, phase, seconds, baseline seconds) for the phases
+    that are slower than the baseline."""
+    for name, phases in results.items():
+        for phase, seconds in phases.items():
+            before = baseline.get(name, dict()).get(phase)
+            if before is None:
+                continue
+            # Very short phases are mostly noise.
+            if seconds > before * (1 + tolerance) and seconds - before > 0.001:
+                yield name, phase, seconds, before
+
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+
+    results = run(mastermind_configurations(args.quick), run_mastermind, args)
+    results.update(run(sudoku_configurations(args.quick), run_sudoku, args))
+
+    with open(args.history, "a") as f:
+        f.write(json.dumps({"time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                            "python": platform.python_version(),
+                            "quick": args.quick,
+                            "seed": args.seed,
+                            "results": results}) + "\n")
+
+    if args.save_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump(results, f, indent=2)
+        print("Saved baseline in", args.baseline)
+        sys.exit()
+
+    try:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    except FileNotFoundError:
+        print("No baseline in", args.baseline)
+        sys.exit()
+
+    found = list(regressions(results, baseline, args.tolerance))
+    for name, phase, seconds, before in found:
+        print("Regression:", name, phase,
+              f"{seconds:.4f}s (was {before:.4f}s)")
+    if found:
+        sys.exit(1)
+    print("No regressions")
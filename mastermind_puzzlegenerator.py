@@ -5,12 +5,22 @@ with both participants' sheets and the stops.
 """
 
 import argparse
-import openpyxl
-import openpyxl.styles
+import collections
+import concurrent.futures
+import dataclasses
+import itertools
+import json
+import multiprocessing
+import operator
 import random
-from openpyxl.styles import Color, PatternFill, Border, Side, Font, \
-    Alignment
-from functools import reduce
+import threading
+import time
+from functools import lru_cache, reduce
+
+from stop_allocation import Crowding, anneal, crowding_weights, \
+    read_distances
+from verification import report
+from workbook_shards import save_shards
 
 HEADING_PER_SHEET = "Lagblankett (svår)"
 HEADING_PER_EASY_SHEET = "Lagblankett"
@@ -61,26 +71,51 @@ radioscouterna."""
 
 ROWS_PER_SHEET = 58
 
-INTRO_ALIGNMENT = Alignment(vertical="top",
-                            wrap_text=True)
-CENTER_ALIGNMENT = Alignment(horizontal="center")
-STOP_ALIGNMENT = CENTER_ALIGNMENT
-CLUE_ALIGNMENT = CENTER_ALIGNMENT
-COLOR_ALIGNMENT = CENTER_ALIGNMENT
-HEADING_FONT = Font(size=9, bold=True)
-SIDE = Side(border_style="thin",
-            color='FF000000')
-
-HEADING_SIDE = Side(border_style="double",
+openpyxl = None
+
+# Held while openpyxl is imported and the styles are created.
+_openpyxl_lock = threading.Lock()
+
+
+def load_openpyxl():
+    """Import openpyxl and create the styles used in the workbook.
+
+    This is done first when something is written so that the sheets can
+    be generated without openpyxl. The lock keeps other threads waiting
+    until the styles are created.
+    """
+    global openpyxl, Color, PatternFill, INTRO_ALIGNMENT, CENTER_ALIGNMENT, \
+        STOP_ALIGNMENT, CLUE_ALIGNMENT, COLOR_ALIGNMENT, HEADING_FONT, \
+        SIDE, HEADING_SIDE, HEADER_BORDER, CELL_BORDER
+    with _openpyxl_lock:
+        if openpyxl is not None:
+            return
+        import openpyxl
+        import openpyxl.styles
+        from openpyxl.styles import Color, PatternFill, Border, Side, Font, \
+            Alignment
+
+        INTRO_ALIGNMENT = Alignment(vertical="top",
+                                    wrap_text=True)
+        CENTER_ALIGNMENT = Alignment(horizontal="center")
+        STOP_ALIGNMENT = CENTER_ALIGNMENT
+        CLUE_ALIGNMENT = CENTER_ALIGNMENT
+        COLOR_ALIGNMENT = CENTER_ALIGNMENT
+        HEADING_FONT = Font(size=9, bold=True)
+        SIDE = Side(border_style="thin",
                     color='FF000000')
-HEADER_BORDER = Border(top=HEADING_SIDE,
-                       bottom=HEADING_SIDE,
-                       left=HEADING_SIDE,
-                       right=HEADING_SIDE)
-CELL_BORDER = Border(top=SIDE,
-                     bottom=SIDE,
-                     left=SIDE,
-                     right=SIDE)
+
+        HEADING_SIDE = Side(border_style="double",
+                            color='FF000000')
+        HEADER_BORDER = Border(top=HEADING_SIDE,
+                               bottom=HEADING_SIDE,
+                               left=HEADING_SIDE,
+                               right=HEADING_SIDE)
+        CELL_BORDER = Border(top=SIDE,
+                             bottom=SIDE,
+                             left=SIDE,
+                             right=SIDE)
+
 
 parser = argparse.ArgumentParser(
     description="Generate a set of mastermind games.")
@@ -97,16 +132,94 @@ parser.add_argument('--stops', type=int, default=15,
 parser.add_argument('--filename', type=str,
                     help='The file where the result is stored',
                     default="mastermind.xlsx")
+parser.add_argument('--minimal', action='store_true',
+                    help='Search for the fewest clue lines that identify '
+                    'the code instead of adding random ones',
+                    default=False)
+parser.add_argument('--search-width', type=int, default=4,
+                    help='Number of best clue lines tried at each step of '
+                    'the minimal search. 0 tries all (slow but optimal)')
+parser.add_argument('--processes', type=int, default=1,
+                    help='Number of processes used by the minimal search')
+parser.add_argument('--workers', type=int, default=1,
+                    help='Number of processes generating sheets while the '
+                    'workbook is written')
+parser.add_argument('--queue-size', type=int, default=4,
+                    help='Number of sheets generated ahead of the one written')
+parser.add_argument('--shard-directory', type=str,
+                    help='Save every sheet, every stop and the correct '
+                    'answers in workbooks of their own in this directory '
+                    'instead of in one file. The --workers processes save '
+                    'them')
+parser.add_argument('--dry-run', action='store_true',
+                    help='Only generate the sheets and print statistics. '
+                    'No workbook is written',
+                    default=False)
+parser.add_argument('--state', type=str,
+                    help='JSON file where the generated set is stored to '
+                    'be able to regenerate parts of it later')
+parser.add_argument('--regenerate-sheet', type=int, action='append',
+                    help='Replace this sheet in the set stored in --state. '
+                    'The new sheet, the correct answers and the stops that '
+                    'get new clues are saved in --filename')
+parser.add_argument('--regenerate-stop', type=int, action='append',
+                    help='Save this stop from the set stored in --state '
+                    'in --filename')
+parser.add_argument('--verify', action='store_true',
+                    help='Check that every team gets the right answers from '
+                    'the stops and can solve its sheet. The saved workbook '
+                    'is read back, or the generated set is checked with '
+                    '--dry-run and --shard-directory',
+                    default=False)
+parser.add_argument('--seed', type=int,
+                    help='Seed for the random numbers to be able to generate '
+                    'the same set again')
+parser.add_argument('--allocation', choices=['simple', 'load'],
+                    default='simple',
+                    help='How the lines of the sheets are mapped to stops. '
+                    'simple gives line 1 stop 1 and so on on every sheet, '
+                    'load gives every sheet its own order so the teams '
+                    'walking them in order are spread over the stops')
+parser.add_argument('--distances', type=str,
+                    help='CSV file with the distances between the stops, '
+                    'one row per stop. With --allocation=load, the walk of '
+                    'each sheet is kept short and stops close to each other '
+                    'are not made busy at the same time')
+parser.add_argument('--anneal-steps', type=int, default=50000,
+                    help='Number of moves tried by --allocation=load')
 parser.add_argument('--debug', '-d', action='store_true',
                     help='Activate trace outputs',
                     default=False)
 
 
-def random_line(args):
+@dataclasses.dataclass
+class MastermindConfig(object):
+    """The settings for generating a set of sheets."""
+    sheets: int = 2
+    easy: int = 0
+    columns: int = 4
+    colors: int = 8
+    stops: int = 15
+    minimal: bool = False
+    search_width: int = 4
+    processes: int = 1
+    allocation: str = "simple"
+    distances: str = None
+    anneal_steps: int = 50000
+    debug: bool = False
+
+    @classmethod
+    def from_args(cls, args):
+        """Creates the config from the parsed command line."""
+        return cls(**{field.name: getattr(args, field.name)
+                      for field in dataclasses.fields(cls)})
+
+
+def random_line(config, rng):
     """Generate a random line."""
     line = []
-    for _ in range(args.columns):
-        line.append(random.randint(1, args.colors))
+    for _ in range(config.columns):
+        line.append(rng.randint(1, config.colors))
     return line
 
 
@@ -118,19 +231,254 @@ class NoCombinationsLeft(Exception):
     pass
 
 
+def all_lines(config):
+    """Generate every possible line, always in the same order."""
+    return [list(line)
+            for line in itertools.product(range(1, config.colors + 1),
+                                          repeat=config.columns)]
+
+
+class FeedbackIndex(object):
+    """Bit set index over all possible lines.
+
+    Every possible line is given a bit so that a set of lines is a
+    python integer. This makes it possible to calculate the answers
+    of a clue line against all lines at once.
+    """
+
+    def __init__(self, config):
+        self.config = config
+        self.lines = all_lines(config)
+        self.all = (1 << len(self.lines)) - 1
+        self.position_masks = [[0] * (config.colors + 1)
+                               for _ in range(config.columns)]
+        self.count_masks = [[0] * (config.columns + 1)
+                            for _ in range(config.colors + 1)]
+        for bit, line in enumerate(self.lines):
+            for i, color in enumerate(line):
+                self.position_masks[i][color] |= 1 << bit
+            for color in range(1, config.colors + 1):
+                self.count_masks[color][line.count(color)] |= 1 << bit
+
+    def bit(self, line):
+        """The bit for the line."""
+        index = 0
+        for color in line:
+            index = index * self.config.colors + color - 1
+        return 1 << index
+
+    def partition(self, clue_line):
+        """Returns a dict (blacks, whites) => bit set of the lines that
+        give that answer for the clue line."""
+        columns = self.config.columns
+        blacks = [self.all] + [0] * columns
+        for i, color in enumerate(clue_line):
+            matched = self.position_masks[i][color]
+            for b in range(i + 1, 0, -1):
+                blacks[b] = (blacks[b] & ~matched) | (blacks[b - 1] & matched)
+            blacks[0] &= ~matched
+        # Total is the number of colors in common, blacks and whites.
+        totals = [self.all] + [0] * columns
+        for color in set(clue_line):
+            count = clue_line.count(color)
+            new_totals = [0] * (columns + 1)
+            for n, mask in enumerate(self.count_masks[color]):
+                shift = min(count, n)
+                for t in range(columns + 1 - shift):
+                    new_totals[t + shift] |= totals[t] & mask
+            totals = new_totals
+        result = dict()
+        for b in range(columns + 1):
+            for t in range(b, columns + 1):
+                mask = blacks[b] & totals[t]
+                if mask:
+                    result[(b, t - b)] = mask
+        return result
+
+    def consistent(self, clue_line, correct):
+        """Returns the answer for the clue line and the bit set of all
+        lines giving the same answer as correct does."""
+        correct_bit = self.bit(correct)
+        for answer, mask in self.partition(clue_line).items():
+            if mask & correct_bit:
+                return answer, mask
+
+
+@lru_cache(maxsize=None)
+def feedback_index(columns, colors):
+    """The FeedbackIndex for the size, shared by all sheets."""
+    return FeedbackIndex(MastermindConfig(columns=columns, colors=colors))
+
+
+def answer_matrix(config, corrects, clue_lines):
+    """Returns the answers for all sheets and all stops at once.
+
+    corrects is the correct line of every sheet and clue_lines is the
+    list of clue lines of every sheet. The result has a list per sheet
+    with a (blacks, whites) tuple per stop.
+    """
+    colors = range(1, config.colors + 1)
+    matrix = []
+    for correct, lines in zip(corrects, clue_lines):
+        correct_counts = [correct.count(c) for c in colors]
+        answers = []
+        for line in lines:
+            blacks = sum(map(operator.eq, correct, line))
+            total = sum(map(min, correct_counts,
+                            [line.count(c) for c in colors]))
+            answers.append((blacks, total - blacks))
+        matrix.append(answers)
+    return matrix
+
+
+_search_masks = None
+
+
+def _set_search_masks(masks):
+    """Set the masks used by _search_branch in a worker process."""
+    global _search_masks
+    _search_masks = masks
+
+
+def _search(masks, remaining, target, depth, width, failed):
+    """Depth first search for at most depth masks that reduce remaining
+    to target.
+
+    Returns the list of indexes into masks or None if not found.
+    Only the width best masks are tried on every level unless width is 0.
+    States that have failed are remembered in failed with the depth.
+    """
+    if remaining == target:
+        return []
+    if depth == 0 or failed.get(remaining, -1) >= depth:
+        return None
+    size = remaining.bit_count()
+    ranked = sorted(((remaining & mask).bit_count(), n)
+                    for n, mask in enumerate(masks))
+    # No line can remove more than the best one does so if depth of them
+    # are not enough, there is no solution here.
+    if (size - ranked[0][0]) * depth < size - 1:
+        failed[remaining] = depth
+        return None
+    if width:
+        ranked = ranked[:width]
+    for count, n in ranked:
+        if count == size:
+            break
+        found = _search(masks, remaining & masks[n], target,
+                        depth - 1, width, failed)
+        if found is not None:
+            return [n] + found
+    failed[remaining] = depth
+    return None
+
+
+def _search_branch(job):
+    n, remaining, target, depth, width = job
+    found = _search(_search_masks, remaining & _search_masks[n], target,
+                    depth - 1, width, dict())
+    if found is None:
+        return None
+    return [n] + found
+
+
+class MinimalClueSearch(object):
+    """Branch and bound search for a minimal set of clue lines.
+
+    A greedy search gives the first solution. After that one line
+    less is searched for until no solution is found. The first level of
+    the search is divided on config.processes processes.
+    """
+
+    def __init__(self, config, correct, easy=False):
+        self.config = config
+        index = feedback_index(config.columns, config.colors)
+        self.target = index.bit(correct)
+        self.lines = []
+        self.answers = []
+        self.masks = []
+        seen = set()
+        for line in index.lines:
+            if line == correct:
+                continue
+            answer, mask = index.consistent(line, correct)
+            if easy and answer[0] == 0:
+                continue
+            if mask in seen:
+                continue
+            seen.add(mask)
+            self.lines.append(line)
+            self.answers.append(answer)
+            self.masks.append(mask)
+        self.all = index.all
+
+    def search(self):
+        """Returns the clue lines and their answers."""
+        best = _search(self.masks, self.all, self.target, self.config.stops,
+                       1, dict())
+        if best is None:
+            raise TooManyClues()
+        width = self.config.search_width
+        pool = None
+        if self.config.processes > 1:
+            pool = multiprocessing.Pool(self.config.processes,
+                                        initializer=_set_search_masks,
+                                        initargs=(self.masks,))
+        try:
+            while len(best) > 1:
+                if self.config.debug:
+                    print("Found", len(best), "lines. Searching for fewer.")
+                found = self._search_depth(len(best) - 1, width, pool)
+                if found is None:
+                    break
+                best = found
+        finally:
+            if pool is not None:
+                pool.terminate()
+        return ([self.lines[n] for n in best],
+                [self.answers[n] for n in best])
+
+    def _search_depth(self, depth, width, pool):
+        if pool is None:
+            return _search(self.masks, self.all, self.target, depth, width,
+                           dict())
+        ranked = sorted(((self.all & mask).bit_count(), n)
+                        for n, mask in enumerate(self.masks))
+        if width:
+            ranked = ranked[:width]
+        jobs = [(n, self.all, self.target, depth, width)
+                for _, n in ranked]
+        for found in pool.imap_unordered(_search_branch, jobs):
+            if found is not None:
+                return found
+        return None
+
+
 class Sheet(object):
-    def __init__(self, args, easy=False):
-        """Creates a sheet."""
-        self.args = args
+    def __init__(self, config, easy=False, rng=None):
+        """Creates a sheet.
+
+        config is a MastermindConfig and rng a random.Random. A new
+        random.Random is used if rng is not given."""
+        self.config = config
         self.easy = easy
-        self.correct = random_line(self.args)
+        if rng is None:
+            rng = random.Random()
+        # line => stop number
+        self.stop_numbers = list(range(1, self.config.stops + 1))
+        self.correct = random_line(self.config, rng)
         self.clue_lines = []
         self.clue_answers = []
-        combs = self.combinations(self.clue_lines)
+        if self.config.minimal:
+            search = MinimalClueSearch(self.config, self.correct, self.easy)
+            self.clue_lines, self.clue_answers = search.search()
+            combs = 1
+        else:
+            combs = self.combinations(self.clue_lines)
         while combs > 1:
-            if len(self.clue_lines) >= self.args.stops:
+            if len(self.clue_lines) >= self.config.stops:
                 raise TooManyClues()
-            new_line = random_line(self.args)
+            new_line = random_line(self.config, rng)
             if new_line == self.correct:
                 # Too easy
                 continue
@@ -144,14 +492,36 @@ class Sheet(object):
                 self.clue_answers.append(self.answer(new_line))
                 combs = new_combs
         self.solvable = len(self.clue_lines)
-        if self.args.debug:
+        if self.config.debug:
             print("Verified that the sheet is solvable.",
                   self.solvable, "lines.")
-        while len(self.clue_lines) < self.args.stops:
-            new_line = random_line(self.args)
+        while len(self.clue_lines) < self.config.stops:
+            new_line = random_line(self.config, rng)
             self.clue_lines.append(new_line)
             self.clue_answers.append(self.answer(new_line))
 
+    def to_state(self):
+        return {"easy": self.easy,
+                "correct": self.correct,
+                "clue_lines": self.clue_lines,
+                "clue_answers": self.clue_answers,
+                "solvable": self.solvable,
+                "stop_numbers": self.stop_numbers}
+
+    @classmethod
+    def from_state(cls, config, state):
+        """Creates the sheet stored with to_state."""
+        sheet = cls.__new__(cls)
+        sheet.config = config
+        sheet.easy = state["easy"]
+        sheet.correct = state["correct"]
+        sheet.clue_lines = state["clue_lines"]
+        sheet.clue_answers = [tuple(a) for a in state["clue_answers"]]
+        sheet.solvable = state["solvable"]
+        sheet.stop_numbers = state.get("stop_numbers",
+                                       list(range(1, config.stops + 1)))
+        return sheet
+
     def answer(self, clue_line, correct=None):
         """Returns a tuple of counts for black and white."""
         if correct is None:
@@ -159,7 +529,7 @@ class Sheet(object):
         count_black = 0
         rest_correct = list(correct)
         rest_clue = list(clue_line)
-        for i in range(self.args.columns):
+        for i in range(self.config.columns):
             if correct[i] == clue_line[i]:
                 count_black += 1
                 rest_correct.remove(correct[i])
@@ -173,45 +543,107 @@ class Sheet(object):
         return count_black, count_white
 
     def combinations(self, clue_lines):
-        reduced_combinations = [set(range(1, self.args.colors + 1))
-                                for _ in range(self.args.columns)]
+        reduced_combinations = [set(range(1, self.config.colors + 1))
+                                for _ in range(self.config.columns)]
         for clue_line in clue_lines:
             black, white = self.answer(clue_line)
             if black == 0 and white == 0:
-                for i in range(self.args.columns):
-                    for j in range(self.args.columns):
+                for i in range(self.config.columns):
+                    for j in range(self.config.columns):
                         if clue_line[j] in reduced_combinations[i]:
                             reduced_combinations[i].remove(clue_line[j])
             elif black == 0:
-                for i in range(self.args.columns):
+                for i in range(self.config.columns):
                     if clue_line[i] in reduced_combinations[i]:
                         reduced_combinations[i].remove(clue_line[i])
-        if self.args.debug:
+        if self.config.debug:
             red = reduce((lambda x, y: x * y),
                          [len(s) for s in reduced_combinations])
-            if red < self.args.columns * self.args.colors:
+            if red < self.config.columns * self.config.colors:
                 print("Reduced combinations:", red)
-        combinations = []
-        for x in reduced_combinations[0]:
-            combinations.append([x])
-        for c in range(1, self.args.columns):
-            old_combinations = combinations
-            combinations = []
-            for x in reduced_combinations[c]:
-                for comb in old_combinations:
-                    combinations.append(comb + [x])
-        valid_combinations = []
-        for comb in combinations:
-            for clue_line in clue_lines:
-                if self.answer(clue_line, comb) != self.answer(clue_line):
-                    break
-            else:
-                valid_combinations.append(comb)
-        if len(valid_combinations) == 0:
+        count = self._count_combinations(clue_lines, reduced_combinations)
+        if count == 0:
             raise NoCombinationsLeft()
-        if self.args.debug:
-            print("Combinations:", len(valid_combinations))
-        return len(valid_combinations)
+        if self.config.debug:
+            print("Combinations:", count)
+        return count
+
+    def _count_combinations(self, clue_lines, reduced_combinations):
+        """Count the lines that give the same answers as correct.
+
+        Bounds on how many times each color can be in the line are
+        derived from the answers. The lines are then built position by
+        position, backtracking as soon as a clue line cannot get its
+        answer any more.
+        """
+        columns = self.config.columns
+        colors = self.config.colors
+        targets = []
+        clue_counts = []
+        for clue_line in clue_lines:
+            black, white = self.answer(clue_line)
+            targets.append((black, black + white))
+            counts = [0] * (colors + 1)
+            for color in clue_line:
+                if color <= colors:
+                    counts[color] += 1
+            clue_counts.append(counts)
+
+        low = [0] * (colors + 1)
+        high = [0] * (colors + 1)
+        for allowed in reduced_combinations:
+            for color in allowed:
+                high[color] += 1
+        for (black, total), counts in zip(targets, clue_counts):
+            for color in range(1, colors + 1):
+                if counts[color]:
+                    # The other colors of the clue cannot give all.
+                    low[color] = max(low[color],
+                                     total - (columns - counts[color]))
+                    if counts[color] > total:
+                        high[color] = min(high[color], total)
+        if sum(low) > columns or any(lo > hi for lo, hi in zip(low, high)):
+            return 0
+        positions = [[color for color in sorted(allowed) if high[color]]
+                     for allowed in reduced_combinations]
+
+        clues = range(len(clue_lines))
+        code_counts = [0] * (colors + 1)
+        blacks = [0] * len(clue_lines)
+        common = [0] * len(clue_lines)
+
+        def count(position, missing):
+            left = columns - position
+            if missing > left:
+                return 0
+            for j in clues:
+                black, total = targets[j]
+                if (blacks[j] > black or black - blacks[j] > left
+                        or common[j] > total or total - common[j] > left):
+                    return 0
+            if left == 0:
+                return 1
+            found = 0
+            for color in positions[position]:
+                if code_counts[color] >= high[color]:
+                    continue
+                changed = []
+                for j in clues:
+                    black = clue_lines[j][position] == color
+                    more = code_counts[color] < clue_counts[j][color]
+                    blacks[j] += black
+                    common[j] += more
+                    changed.append((j, black, more))
+                code_counts[color] += 1
+                found += count(position + 1,
+                               missing - (code_counts[color] <= low[color]))
+                code_counts[color] -= 1
+                for j, black, more in changed:
+                    blacks[j] -= black
+                    common[j] -= more
+            return found
+
+        return count(0, sum(low))
 
     def output(self, ws, sheet_identity, start_row, replacement):
         """Will fill the worksheet from line start_line with the sheet.
@@ -226,8 +658,9 @@ class Sheet(object):
         The empty columns are to enter "black" and "white" responses.
         Headers are created.
         """
+        load_openpyxl()
         stop_column = 1
-        black_column = 1 + self.args.columns + 2
+        black_column = 1 + self.config.columns + 2
         white_column = black_column + 1
         clue_column = white_column + 1
 
@@ -248,7 +681,7 @@ class Sheet(object):
 
         row += intro_lines + 2
         ws.cell(row=row, column=1).value = CORRECT_HEADING
-        for column in range(self.args.columns):
+        for column in range(self.config.columns):
             ws.cell(row=row, column=2 + column).border = HEADER_BORDER
 
         row += 2
@@ -269,9 +702,9 @@ class Sheet(object):
         ws.cell(row=row, column=clue_column).alignment = CENTER_ALIGNMENT
 
         row += 1
-        for line in range(self.args.stops):
+        for line in range(self.config.stops):
             ws.cell(row=row + line,
-                    column=stop_column).value = line + 1
+                    column=stop_column).value = self.stop_numbers[line]
             ws.cell(row=row + line,
                     column=stop_column).border = CELL_BORDER
             ws.cell(row=row + line,
@@ -282,11 +715,12 @@ class Sheet(object):
             ws.cell(row=row + line,
                     column=white_column).border = CELL_BORDER
 
-            code = replacement.generate_clue(line + 1, self.clue_answers[line])
+            code = replacement.generate_clue(self.stop_numbers[line],
+                                             self.clue_answers[line])
             ws.cell(row=row + line, column=clue_column).value = code
             ws.cell(row=row + line, column=clue_column).border = CELL_BORDER
 
-            for column in range(self.args.columns):
+            for column in range(self.config.columns):
                 cell = ws.cell(row=row + line, column=2 + column)
                 cell.value = self.clue_lines[line][column]
                 cell.border = CELL_BORDER
@@ -300,117 +734,297 @@ class Sheet(object):
         assert row - start_row < ROWS_PER_SHEET
 
 
+def _generate_sheet(job):
+    config, easy, seed = job
+    return Sheet(config, easy, random.Random(seed))
+
+
+def generate_sheets(config, workers, queue_size, rng=None):
+    """Generate the sheets in worker processes.
+
+    The sheets are returned in order as soon as they are finished. At
+    most queue_size sheets are generated ahead of the last one returned.
+    Each sheet gets its own seed from rng, all drawn before any sheet is
+    generated, so the same sheets are generated whatever the number of
+    workers. With one worker no processes are started.
+    """
+    if rng is None:
+        rng = random.Random()
+    jobs = [(config, index < config.easy, rng.getrandbits(64))
+            for index in range(config.sheets)]
+    if workers <= 1:
+        return map(_generate_sheet, jobs)
+    return _generate_in_pool(jobs, workers, queue_size)
+
+
+def _generate_in_pool(jobs, workers, queue_size):
+    with concurrent.futures.ProcessPoolExecutor(workers) as executor:
+        pending = collections.deque()
+        for job in jobs:
+            if len(pending) >= queue_size:
+                yield pending.popleft().result()
+            pending.append(executor.submit(_generate_sheet, job))
+        while pending:
+            yield pending.popleft().result()
+
+
+class RouteAllocation(object):
+    """Orders the stops of the sheets to spread the teams.
+
+    Every team walks the lines of its sheet in order. The load of a stop
+    in each step of the walk is the number of teams there. With distances
+    the length of the walks is also a cost, one per mean distance.
+    """
+
+    def __init__(self, orders, movable, weights=None, distances=None):
+        """orders has the stop index of every line of every sheet.
+
+        Only the sheets in movable are changed."""
+        self.orders = orders
+        self._movable = movable
+        stops = len(orders[0])
+        self._steps = []
+        for step in range(stops):
+            loads = [0] * stops
+            for order in orders:
+                loads[order[step]] += 1
+            self._steps.append(Crowding(loads, weights))
+        self._distances = distances
+        if distances:
+            mean = sum(map(sum, distances)) / max(1, stops * (stops - 1))
+            self._scale = 1 / mean if mean else 0
+
+    def cost(self):
+        cost = sum(step.cost() for step in self._steps)
+        if self._distances:
+            cost += sum(self._walk(order, range(len(order) - 1))
+                        for order in self.orders)
+        return cost
+
+    def _walk(self, order, legs):
+        """Returns the cost of walking the legs of order."""
+        return self._scale * sum(self._distances[order[leg]][order[leg + 1]]
+                                 for leg in legs)
+
+    def propose(self, rng):
+        """Returns (change of cost, move) for swapping two lines of a
+        random sheet."""
+        sheet = rng.choice(self._movable)
+        order = self.orders[sheet]
+        first, second = rng.sample(range(len(order)), 2)
+        a, b = order[first], order[second]
+        delta = (self._steps[first].delta({a: -1, b: 1})
+                 + self._steps[second].delta({b: -1, a: 1}))
+        if self._distances:
+            legs = {leg for line in (first, second)
+                    for leg in (line - 1, line) if 0 <= leg < len(order) - 1}
+            before = self._walk(order, legs)
+            order[first], order[second] = b, a
+            delta += self._walk(order, legs) - before
+            order[first], order[second] = a, b
+        return delta, (sheet, first, second)
+
+    def apply(self, move):
+        sheet, first, second = move
+        order = self.orders[sheet]
+        a, b = order[first], order[second]
+        self._steps[first].apply({a: -1, b: 1})
+        self._steps[second].apply({b: -1, a: 1})
+        order[first], order[second] = b, a
+
+
+def allocate_stops(config, sheets, rng, movable=None):
+    """Give the sheets orders of the stops that spread the teams.
+
+    Only the sheets with an index in movable, all if not given, get new
+    orders. The others keep theirs."""
+    distances = weights = None
+    if config.distances:
+        distances = read_distances(config.distances, config.stops)
+        weights = crowding_weights(distances)
+    if movable is None:
+        movable = range(len(sheets))
+    orders = [[number - 1 for number in s.stop_numbers] for s in sheets]
+    for index in movable:
+        rng.shuffle(orders[index])
+    allocation = RouteAllocation(orders, list(movable), weights, distances)
+    if config.stops > 1 and movable:
+        before = allocation.cost()
+        anneal(allocation, config.anneal_steps, rng)
+        if config.debug:
+            print("Route cost", before, "=>", allocation.cost())
+    for s, order in zip(sheets, allocation.orders):
+        s.stop_numbers = [index + 1 for index in order]
+
+
+def feedback_classes(columns):
+    """Returns all possible (blacks, whites) answers."""
+    return [(blacks, whites)
+            for blacks in range(columns + 1)
+            for whites in range(columns + 1 - blacks)
+            if (blacks, whites) != (columns - 1, 1)]
+
+
 class Stops(object):
     """Maintains all informations from all stops as gotten from each sheet.
 
-    Generates clues as information is added acting as the replacement
+    All clues are allocated up front, one for every stop and possible
+    answer, and the ones used are remembered. Acts as the replacement
     object when creating sheets."""
 
-    def __init__(self, args):
-        self.args = args
-        self.stop_infos = dict()
-        self.max_clues = self.args.stops * self.args.sheets
-        self.next_clue = self.generate_clues()
+    def __init__(self, config, rng=None, clues=None):
+        """Creates the stops.
+
+        The clues are drawn from rng unless clues, as in self.clues, is
+        given."""
+        self.config = config
+        if rng is None:
+            rng = random.Random()
+        self.rng = rng
+        self.classes = feedback_classes(self.config.columns)
+        # blacks, whites => index in classes
+        self.class_index = [[None] * (self.config.columns + 1)
+                            for _ in range(self.config.columns + 1)]
+        for n, (blacks, whites) in enumerate(self.classes):
+            self.class_index[blacks][whites] = n
+        self.max_clues = self.config.stops * len(self.classes)
+        if clues is None:
+            next_clue = self.generate_clues()
+            clues = [[next(next_clue) for _ in self.classes]
+                     for _ in range(self.config.stops)]
+        # stop index => class index => clue
+        self.clues = clues
+        # stop index => [(clue, class index), ...] sorted by clue
+        self.ordered = [sorted((clue, n) for n, clue in enumerate(clues))
+                        for clues in self.clues]
+        # stop index => bit set of the class indexes used
+        self.used = [0] * self.config.stops
+
+    @property
+    def stop_infos(self):
+        """Dict stop => answer => clue for the used answers."""
+        return {stop_index + 1: {self.classes[n]: clue
+                                 for clue, n in self.ordered[stop_index]
+                                 if used >> n & 1}
+                for stop_index, used in enumerate(self.used)
+                if used}
 
     def generate_clues(self):
         clues = list(range(100, 100 + self.max_clues))
-        random.shuffle(clues)
+        self.rng.shuffle(clues)
         for c in clues:
             yield c
 
     def generate_clue(self, stop, tuple):
-        if stop not in self.stop_infos:
-            self.stop_infos[stop] = dict()
-        if tuple not in self.stop_infos[stop]:
-            self.stop_infos[stop][tuple] = next(self.next_clue)
-        return self.stop_infos[stop][tuple]
+        n = self.class_index[tuple[0]][tuple[1]]
+        self.used[stop - 1] |= 1 << n
+        return self.clues[stop - 1][n]
+
+    def is_used(self, stop, tuple):
+        """True if the answer tuple is already used on stop."""
+        n = self.class_index[tuple[0]][tuple[1]]
+        return bool(self.used[stop - 1] >> n & 1)
+
+    def add_answers(self, matrix, stop_numbers=None):
+        """Mark all answers in matrix as used.
+
+        matrix is as returned by answer_matrix. stop_numbers has the
+        stop numbers of the lines of each sheet, if not in order."""
+        in_order = range(1, self.config.stops + 1)
+        for n, answers in enumerate(matrix):
+            numbers = stop_numbers[n] if stop_numbers else in_order
+            for stop_number, (blacks, whites) in zip(numbers, answers):
+                self.used[stop_number - 1] |= (
+                    1 << self.class_index[blacks][whites])
+
+    def to_state(self):
+        return {"clues": self.clues, "used": self.used}
+
+    @classmethod
+    def from_state(cls, config, state):
+        """Creates the stops stored with to_state."""
+        stops = cls(config, clues=state["clues"])
+        stops.used = state["used"]
+        return stops
 
     def output(self, ws, start_row):
-        for stop_number, _ in enumerate(range(self.args.stops), start=1):
-            ws.merge_cells(start_row=start_row, end_row=start_row,
-                           start_column=1, end_column=9)
-            ws.cell(row=start_row,
-                    column=1).value = HEADING_PER_STOP + " " + str(stop_number)
-            ws.cell(row=start_row,
-                    column=1).alignment = INTRO_ALIGNMENT
-            row = start_row + 3
-
-            intro_lines = 6
-            ws.merge_cells(start_row=row, end_row=row + intro_lines,
-                           start_column=1, end_column=9)
-            ws.cell(row=row, column=1).value = INTRO_TEXT_PER_STOP
-            ws.cell(row=row, column=1).alignment = INTRO_ALIGNMENT
-
-            row += intro_lines + 2
-            clue_column = 1
-            black_column = 2
-            white_column = 3
-
-            ws.cell(row=row, column=clue_column).value = CLUE_HEADING
-            ws.cell(row=row, column=clue_column).border = HEADER_BORDER
-            ws.cell(row=row, column=clue_column).alignment = CLUE_ALIGNMENT
-
-            ws.cell(row=row, column=black_column).value = BLACK_HEADING
-            ws.cell(row=row, column=black_column).border = HEADER_BORDER
-            ws.cell(row=row, column=black_column).alignment = CLUE_ALIGNMENT
-
-            ws.cell(row=row, column=white_column).value = WHITE_HEADING
-            ws.cell(row=row, column=white_column).border = HEADER_BORDER
-            ws.cell(row=row, column=white_column).alignment = CLUE_ALIGNMENT
-
-            row += 2
-            for clue, tuple in sorted([(v, k,)
-                                       for k, v
-                                       in self.stop_infos[stop_number].items()
-                                       ]):
-                blacks, whites = tuple
-                ws.cell(row=row,
-                        column=clue_column).value = str(clue)
-                ws.cell(row=row,
-                        column=clue_column).border = CELL_BORDER
-                ws.cell(row=row,
-                        column=clue_column).alignment = CLUE_ALIGNMENT
-
-                ws.cell(row=row,
-                        column=black_column).value = str(blacks)
-                ws.cell(row=row,
-                        column=black_column).border = CELL_BORDER
-                ws.cell(row=row,
-                        column=black_column).alignment = CLUE_ALIGNMENT
-
-                ws.cell(row=row,
-                        column=white_column).value = str(whites)
-                ws.cell(row=row,
-                        column=white_column).border = CELL_BORDER
-                ws.cell(row=row,
-                        column=white_column).alignment = CLUE_ALIGNMENT
-
-                row += 1
-
-            assert row - start_row < ROWS_PER_SHEET
+        for stop_number, _ in enumerate(range(self.config.stops), start=1):
+            self.output_stop(ws, stop_number, start_row)
             start_row += ROWS_PER_SHEET
 
+    def output_stop(self, ws, stop_number, start_row):
+        load_openpyxl()
+        ws.merge_cells(start_row=start_row, end_row=start_row,
+                       start_column=1, end_column=9)
+        ws.cell(row=start_row,
+                column=1).value = HEADING_PER_STOP + " " + str(stop_number)
+        ws.cell(row=start_row,
+                column=1).alignment = INTRO_ALIGNMENT
+        row = start_row + 3
 
-if __name__ == "__main__":
-    args = parser.parse_args()
+        intro_lines = 6
+        ws.merge_cells(start_row=row, end_row=row + intro_lines,
+                       start_column=1, end_column=9)
+        ws.cell(row=row, column=1).value = INTRO_TEXT_PER_STOP
+        ws.cell(row=row, column=1).alignment = INTRO_ALIGNMENT
 
-    wb = openpyxl.Workbook()
-    ws = wb.active
+        row += intro_lines + 2
+        clue_column = 1
+        black_column = 2
+        white_column = 3
+
+        ws.cell(row=row, column=clue_column).value = CLUE_HEADING
+        ws.cell(row=row, column=clue_column).border = HEADER_BORDER
+        ws.cell(row=row, column=clue_column).alignment = CLUE_ALIGNMENT
 
-    stops = Stops(args)
+        ws.cell(row=row, column=black_column).value = BLACK_HEADING
+        ws.cell(row=row, column=black_column).border = HEADER_BORDER
+        ws.cell(row=row, column=black_column).alignment = CLUE_ALIGNMENT
 
-    row = 1
-    correct_lines = dict()
-    for index in range(args.sheets):
-        sheet_number = 1 + index
-        s = Sheet(args, index < args.easy)
-        print(s.correct)
-        print(s.clue_lines)
-        correct_lines[sheet_number] = (s.correct, s.solvable)
+        ws.cell(row=row, column=white_column).value = WHITE_HEADING
+        ws.cell(row=row, column=white_column).border = HEADER_BORDER
+        ws.cell(row=row, column=white_column).alignment = CLUE_ALIGNMENT
 
-        s.output(ws, str(sheet_number), row, stops)
-        row += ROWS_PER_SHEET
+        row += 2
+        used = self.used[stop_number - 1]
+        for clue, n in self.ordered[stop_number - 1]:
+            if not used >> n & 1:
+                continue
+            blacks, whites = self.classes[n]
+            ws.cell(row=row,
+                    column=clue_column).value = str(clue)
+            ws.cell(row=row,
+                    column=clue_column).border = CELL_BORDER
+            ws.cell(row=row,
+                    column=clue_column).alignment = CLUE_ALIGNMENT
+
+            ws.cell(row=row,
+                    column=black_column).value = str(blacks)
+            ws.cell(row=row,
+                    column=black_column).border = CELL_BORDER
+            ws.cell(row=row,
+                    column=black_column).alignment = CLUE_ALIGNMENT
+
+            ws.cell(row=row,
+                    column=white_column).value = str(whites)
+            ws.cell(row=row,
+                    column=white_column).border = CELL_BORDER
+            ws.cell(row=row,
+                    column=white_column).alignment = CLUE_ALIGNMENT
+
+            row += 1
+
+        assert row - start_row < ROWS_PER_SHEET
 
+
+def output_correct_answers(ws, config, correct_lines, row):
+    """Fill the worksheet from row with the correct line and the number
+    of lines needed to solve it for every sheet.
+
+    correct_lines is a dict sheet number => (correct, solvable). Returns
+    the row after the last page written.
+    """
+    load_openpyxl()
     correct_answers_heading_written = False
     line = 0
     for sheet_number, tuple in correct_lines.items():
@@ -422,26 +1036,335 @@ if __name__ == "__main__":
             ws.cell(row=row + 2,
                     column=1).value = CORRECT_HEADING
             ws.cell(row=row + 2,
-                    column=2 + args.columns + 1).value = SOLVED_IN_HEADING
+                    column=2 + config.columns + 1).value = SOLVED_IN_HEADING
             line = 3
 
         ws.cell(row=row + line, column=1).value = sheet_number
-        for column in range(args.columns):
+        for column in range(config.columns):
             cell = ws.cell(row=row + line, column=2 + column)
             cell.value = correct[column]
             cell.border = CELL_BORDER
             cell.alignment = COLOR_ALIGNMENT
             cell.fill = PatternFill("solid",
                                     fgColor=Color(indexed=8 + correct[column]))
-        ws.cell(row=row + line, column=2 + args.columns + 1).value = solvable
+        ws.cell(row=row + line, column=2 + config.columns + 1).value = solvable
 
         line += 1
         if line > ROWS_PER_SHEET - 5:
             correct_answers_heading_written = False
             row += ROWS_PER_SHEET
 
-    row += ROWS_PER_SHEET
+    return row + ROWS_PER_SHEET
+
+
+def save_state(filename, config, sheets, stops):
+    """Store the set in filename to be read with load_state."""
+    with open(filename, "w") as f:
+        json.dump({"config": dataclasses.asdict(config),
+                   "sheets": [s.to_state() for s in sheets],
+                   "stops": stops.to_state()}, f)
+
+
+def load_state(filename):
+    """Returns the config, sheets and stops stored with save_state."""
+    with open(filename) as f:
+        state = json.load(f)
+    config = MastermindConfig(**state["config"])
+    return (config,
+            [Sheet.from_state(config, s) for s in state["sheets"]],
+            Stops.from_state(config, state["stops"]))
+
+
+# Number of sheets tried when regenerating a sheet.
+REGENERATE_ATTEMPTS = 50
+# Number of times a line not needed to solve the sheet is drawn again.
+REDRAW_ATTEMPTS = 20
+
+
+def regenerate_sheet(config, old, stops, rng):
+    """Returns a new sheet to replace old.
+
+    The new sheet keeps the stop order of old. Of REGENERATE_ATTEMPTS
+    sheets, the one chosen uses the fewest answers that are not already
+    on the stops, so that as few stops as possible must be printed again.
+    The lines that are not needed to solve a sheet are drawn again until
+    their answers are already on their stops.
+    """
+    best = None
+    for _ in range(REGENERATE_ATTEMPTS):
+        sheet = Sheet(config, old.easy, rng)
+        sheet.stop_numbers = list(old.stop_numbers)
+        for line in range(sheet.solvable, config.stops):
+            stop_number = sheet.stop_numbers[line]
+            for _ in range(REDRAW_ATTEMPTS):
+                if stops.is_used(stop_number, sheet.clue_answers[line]):
+                    break
+                sheet.clue_lines[line] = random_line(config, rng)
+                sheet.clue_answers[line] = sheet.answer(sheet.clue_lines[line])
+        new = {(stop_number, answer)
+               for stop_number, answer in zip(sheet.stop_numbers,
+                                              sheet.clue_answers)
+               if not stops.is_used(stop_number, answer)}
+        cost = (len({stop_number for stop_number, _ in new}), len(new))
+        if best is None or cost < best[0]:
+            best = (cost, sheet)
+        if not new:
+            break
+    return best[1]
+
+
+def check_numbers(option, numbers, count):
+    """Exit with a usage error unless all numbers are from 1 to count."""
+    for number in numbers or ():
+        if not 1 <= number <= count:
+            parser.error(f"{option} must be from 1 to {count}, not {number}")
+
+
+def regenerate(args, rng):
+    """Replace the sheets args.regenerate_sheet in the set in args.state.
+
+    The clues of the stops are kept so only the new sheets, the correct
+    answers and the stops where a new sheet uses an answer that was not
+    used before are saved in args.filename together with the stops in
+    args.regenerate_stop.
+    """
+    config, sheets, stops = load_state(args.state)
+    check_numbers("--regenerate-sheet", args.regenerate_sheet, len(sheets))
+    check_numbers("--regenerate-stop", args.regenerate_stop, config.stops)
+    used = list(stops.used)
+
+    load_openpyxl()
+    wb = openpyxl.Workbook()
+    ws = wb.active
+
+    row = 1
+    for sheet_number in args.regenerate_sheet or ():
+        s = regenerate_sheet(config, sheets[sheet_number - 1], stops, rng)
+        sheets[sheet_number - 1] = s
+        # Marks the answers as used before the next sheet is chosen.
+        s.output(ws, str(sheet_number), row, stops)
+        row += ROWS_PER_SHEET
+
+    if args.regenerate_sheet:
+        row = output_correct_answers(ws, config,
+                                     {n: (s.correct, s.solvable)
+                                      for n, s in enumerate(sheets, start=1)},
+                                     row)
+
+    changed = [stop_index + 1
+               for stop_index in range(config.stops)
+               if stops.used[stop_index] != used[stop_index]]
+    for stop_number in sorted(set(changed + (args.regenerate_stop or []))):
+        stops.output_stop(ws, stop_number, row)
+        row += ROWS_PER_SHEET
+
+    save_state(args.state, config, sheets, stops)
+    wb.save(args.filename)
+    print("Changed stops:", changed)
+    print("Saved output in", args.filename)
+
+
+def read_workbook(filename, config):
+    """Returns the teams' view of the set saved in filename.
+
+    The result is (lines, corrects, stop_clues) where lines is a dict
+    sheet number => [(stop number, clue line, clue), ...], corrects a
+    dict sheet number => (correct, solvable) from the facit and stop_clues
+    a dict stop number => clue => (blacks, whites). The workbook is read
+    one row at a time in read-only mode.
+    """
+    load_openpyxl()
+    wb = openpyxl.load_workbook(filename, read_only=True)
+    columns = config.columns
+    lines, corrects, stop_clues = dict(), dict(), dict()
+    page = None
+    for row in wb.active.iter_rows(values_only=True):
+        row = row + (None,) * (columns + 5 - len(row))
+        first = row[0]
+        if isinstance(first, str):
+            if first.startswith(HEADING_PER_STOP):
+                page = stop_clues.setdefault(int(first.split()[-1]), dict())
+            elif first.startswith(HEADING_PER_EASY_SHEET):
+                page = lines.setdefault(int(first.split()[-1]), [])
+            elif first == HEADING_CORRECT_ANSWERS:
+                page = corrects
+            elif isinstance(page, dict) and page is not corrects \
+                    and first.isdigit():
+                page[int(first)] = (int(row[1]), int(row[2]))
+        elif isinstance(first, int):
+            if isinstance(page, list):
+                page.append((first, list(row[1:1 + columns]),
+                             row[columns + 4]))
+            elif page is corrects:
+                corrects[first] = (list(row[1:1 + columns]), row[columns + 2])
+    wb.close()
+    return lines, corrects, stop_clues
+
+
+def team_view(sheets, stops):
+    """Returns the teams' view of the generated set as read_workbook."""
+    lines = {n: [(stop_number, line,
+                  stops.clues[stop_number - 1][
+                      stops.class_index[answer[0]][answer[1]]])
+                 for stop_number, line, answer
+                 in zip(s.stop_numbers, s.clue_lines, s.clue_answers)]
+             for n, s in enumerate(sheets, start=1)}
+    corrects = {n: (s.correct, s.solvable)
+                for n, s in enumerate(sheets, start=1)}
+    stop_clues = {stop_number: {clue: answer
+                                for answer, clue in infos.items()}
+                  for stop_number, infos in stops.stop_infos.items()}
+    return lines, corrects, stop_clues
+
+
+def verify_set(config, lines, corrects, stop_clues):
+    """Check the teams' view of a set, as returned by read_workbook.
+
+    Every clue must be on its stop with the answer that the clue line
+    gives for the correct line. The answers of the lines must leave only
+    the correct line, already after the number of lines in the facit.
+    All answers are calculated at once and the lines left are kept as
+    bit sets. Returns a list of the errors found.
+    """
+    index = feedback_index(config.columns, config.colors)
+    errors = [f"Sheet {n} is not in the facit"
+              for n in sorted(set(lines) - set(corrects))]
+    errors.extend(f"Sheet {n} in the facit is missing"
+                  for n in sorted(set(corrects) - set(lines)))
+    numbers = sorted(set(lines) & set(corrects))
+    matrix = answer_matrix(config,
+                           [corrects[n][0] for n in numbers],
+                           [[line for _, line, _ in lines[n]]
+                            for n in numbers])
+    for n, answers in zip(numbers, matrix):
+        correct, solvable = corrects[n]
+        possible = index.all
+        # With only one possible line it is solved before any clue.
+        solved = possible
+        for line_number, ((stop_number, line, clue), answer) in enumerate(
+                zip(lines[n], answers), start=1):
+            found = stop_clues.get(stop_number, dict()).get(clue)
+            if found is None:
+                errors.append(f"Sheet {n} line {line_number}: clue {clue} "
+                              f"is not on stop {stop_number}")
+            elif found != answer:
+                errors.append(f"Sheet {n} line {line_number}: clue {clue} "
+                              f"gives {found} instead of {answer}")
+            else:
+                possible &= index.partition(line).get(answer, 0)
+            if line_number == solvable:
+                solved = possible
+        if possible != index.bit(correct):
+            errors.append(f"Sheet {n}: the answers do not lead to "
+                          f"{correct} only")
+        elif solved != possible:
+            errors.append(f"Sheet {n}: not solved after {solvable} lines")
+    return errors
+
+
+def print_statistics(config, sheets, stops, seconds):
+    """Print a summary of the generated sheets and stops."""
+    solvable = [s.solvable for s in sheets]
+    clues = [used.bit_count() for used in stops.used]
+    print("Sheets:", len(sheets),
+          "of which easy:", len([s for s in sheets if s.easy]))
+    print("Lines to solve: min", min(solvable),
+          "average", round(sum(solvable) / len(solvable), 1),
+          "max", max(solvable))
+    print("Clues per stop: min", min(clues), "max", max(clues))
+    busiest = max(collections.Counter(numbers).most_common(1)[0][1]
+                  for numbers in zip(*(s.stop_numbers for s in sheets)))
+    print("Most teams at a stop on the same line:", busiest)
+    print("Generated in", round(seconds, 2), "seconds")
+
+
+def main(argv=None):
+    """Generate a set from the command line arguments in argv."""
+    args = parser.parse_args(argv)
+    config = MastermindConfig.from_args(args)
+    rng = random.Random(args.seed)
+
+    if args.regenerate_sheet or args.regenerate_stop:
+        if not args.state:
+            parser.error("--state is needed to regenerate")
+        regenerate(args, rng)
+        return
+
+    stops = Stops(config, rng)
+
+    started = time.perf_counter()
+    sheets = generate_sheets(config, args.workers, args.queue_size, rng)
+    if args.workers <= 1:
+        sheets = list(sheets)
+    # Else the clues are generated as the sheets are written.
+    if args.shard_directory or args.dry_run or config.allocation == "load":
+        # All clues are needed before the sheets are saved in parallel
+        # and for the statistics. All sheets are ordered together.
+        sheets = list(sheets)
+    if config.allocation == "load":
+        allocate_stops(config, sheets, rng)
+    if (args.workers <= 1 or args.shard_directory or args.dry_run
+            or config.allocation == "load"):
+        stops.add_answers(answer_matrix(config,
+                                        [s.correct for s in sheets],
+                                        [s.clue_lines for s in sheets]),
+                          [s.stop_numbers for s in sheets])
+
+    if args.dry_run:
+        print_statistics(config, sheets, stops,
+                         time.perf_counter() - started)
+        if args.verify:
+            view = team_view(sheets, stops)
+            report(verify_set(config, *view), len(view[0]))
+        return
+
+    load_openpyxl()
+    wb = openpyxl.Workbook()
+    ws = wb.active
+
+    row = 1
+    correct_lines = dict()
+    shards = []
+    generated = []
+    for sheet_number, s in enumerate(sheets, start=1):
+        print(s.correct)
+        print(s.clue_lines)
+        correct_lines[sheet_number] = (s.correct, s.solvable)
+        generated.append(s)
+
+        if args.shard_directory:
+            shards.append(("sheet", sheet_number, s.output,
+                           (str(sheet_number), 1, stops)))
+            continue
+        s.output(ws, str(sheet_number), row, stops)
+        row += ROWS_PER_SHEET
 
-    stops.output(ws, row)
+    if args.shard_directory:
+        shards.append(("facit", None, output_correct_answers,
+                       (config, correct_lines, 1)))
+        for stop_number in range(1, 1 + config.stops):
+            shards.append(("stop", stop_number, stops.output_stop,
+                           (stop_number, 1)))
+        save_shards(args.shard_directory, shards, args.workers)
+        print("Saved output in", args.shard_directory)
+    else:
+        row = output_correct_answers(ws, config, correct_lines, row)
 
-    wb.save("mm.xlsx")
+        stops.output(ws, row)
+
+        wb.save(args.filename)
+        print("Saved output in", args.filename)
+
+    if args.state:
+        save_state(args.state, config, generated, stops)
+
+    if args.verify:
+        if args.shard_directory:
+            view = team_view(generated, stops)
+        else:
+            view = read_workbook(args.filename, config)
+        report(verify_set(config, *view), len(view[0]))
+
+
+if __name__ == "__main__":
+    main()
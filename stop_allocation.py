@@ -0,0 +1,113 @@
+"""Spreads the teams' visits evenly over the stops.
+
+The load of a stop is the time the teams spend there. The crowding of a
+stop is its load plus the load of the stops near it, weighted by how near
+they are, if the distances between the stops are known. The cost of an
+allocation is the sum of the load times the crowding of every stop, less
+what it would be with the same total load evenly spread. It is lowered by
+simulated annealing.
+
+The problems keep the load of every stop so the change of the cost of a
+move is calculated from the stops the move changes only.
+
+The distances are read from a CSV file with one row per stop, in the
+order of the stop numbers.
+"""
+
+import csv
+import math
+
+
+# A visit to a stop takes as long as looking up this many clues.
+VISIT_COST = 3
+
+
+def read_distances(filename, stops):
+    """Returns the distance matrix in filename."""
+    with open(filename, newline="") as f:
+        distances = [[float(d) for d in row] for row in csv.reader(f) if row]
+    if len(distances) != stops or any(len(row) != stops for row in distances):
+        raise ValueError(f"{filename} must have {stops} rows with "
+                         f"{stops} distances each")
+    return distances
+
+
+def crowding_weights(distances):
+    """Returns how much the load of each stop crowds every other stop.
+
+    A stop at an eighth of the median distance counts a third. Further
+    away they soon do not count. Without distances there are no weights
+    and each stop is only crowded by itself."""
+    if distances is None:
+        return None
+    nonzero = sorted(d for row in distances for d in row if d > 0)
+    scale = nonzero[len(nonzero) // 2] / 8 if nonzero else 1
+    return [[1 if n == m else math.exp(-d / scale)
+             for m, d in enumerate(row)]
+            for n, row in enumerate(distances)]
+
+
+class Crowding(object):
+    """The sum of the load times the crowding of the stops, less the
+    same for the mean load."""
+
+    def __init__(self, loads, weights=None):
+        self.loads = list(loads)
+        self.weights = weights
+        self.total = sum(self.loads)
+        if weights is None:
+            self.crowding = self.loads
+            self._even = 1 / len(self.loads)
+        else:
+            self.crowding = [sum(w * load for w, load in zip(row, self.loads))
+                             for row in weights]
+            self._even = sum(map(sum, weights)) / len(self.loads) ** 2
+
+    def cost(self):
+        return (sum(load * c for load, c in zip(self.loads, self.crowding))
+                - self._even * self.total ** 2)
+
+    def delta(self, changes):
+        """Returns the change of the cost if the loads change.
+
+        changes is a dict stop index => change of load. Only the changed
+        stops are looked at."""
+        total = sum(changes.values())
+        delta = (sum(2 * self.crowding[stop] * change
+                     for stop, change in changes.items())
+                 - self._even * (2 * self.total * total + total * total))
+        if self.weights is None:
+            return delta + sum(change * change for change in changes.values())
+        return delta + sum(self.weights[stop][other] * change * c
+                           for stop, change in changes.items()
+                           for other, c in changes.items())
+
+    def apply(self, changes):
+        for stop, change in changes.items():
+            self.loads[stop] += change
+            self.total += change
+        if self.weights is not None:
+            for n, row in enumerate(self.weights):
+                self.crowding[n] += sum(row[stop] * c
+                                        for stop, c in changes.items())
+
+
+def anneal(problem, steps, rng):
+    """Improve problem by simulated annealing during steps moves.
+
+    problem.propose(rng) returns (change of cost, move) for a random move
+    and problem.apply(move) makes it. The start temperature is the mean
+    change of some moves and it is lowered to a thousandth of that.
+    """
+    samples = [abs(problem.propose(rng)[0]) for _ in range(min(steps, 100))]
+    samples = [delta for delta in samples if delta]
+    if not samples:
+        return
+    start = sum(samples) / len(samples)
+    for step in range(steps):
+        temperature = start * 0.001 ** (step / steps)
+        delta, move = problem.propose(rng)
+        if move is None:
+            continue
+        if delta <= 0 or rng.random() < math.exp(-delta / temperature):
+            problem.apply(move)
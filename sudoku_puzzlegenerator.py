@@ -11,9 +11,19 @@ Hard:
 """
 
 import argparse
-import openpyxl
-import openpyxl.styles
+import array
+import collections
+import dataclasses
+import json
 import random
+import tempfile
+import threading
+import time
+
+from stop_allocation import VISIT_COST, Crowding, anneal, \
+    crowding_weights, read_distances
+from verification import report
+from workbook_shards import save_shards
 
 
 HEADING_PER_SHEET = "Deltagarblankett"
@@ -34,6 +44,9 @@ INTRO_TEXT_PER_STOP = """Detta är en kontroll för Radiosudoku."""
 
 ROWS_PER_SHEET = 51
 
+# The first row of the board on the page of a sheet.
+BOARD_ROW = 15
+
 
 parser = argparse.ArgumentParser(description="Generate a set of sudoku games.")
 parser.add_argument('--sheets', type=int, default=2,
@@ -49,23 +62,110 @@ parser.add_argument('--clue-letters', type=str,
 parser.add_argument('--filename', type=str,
                     help='The file where the result is stored',
                     default="sudoku.xlsx")
+parser.add_argument('--streaming', action='store_true',
+                    help='Keep the sheets in a temporary file and write the '
+                    'workbook as it is generated. Uses less memory for '
+                    'many sheets',
+                    default=False)
+parser.add_argument('--allocation', choices=['simple', 'load'],
+                    default='simple',
+                    help='How the clues are spread over the stops. simple '
+                    'gives the stops about the same number of clues, load '
+                    'spreads the time the teams spend at the stops')
+parser.add_argument('--distances', type=str,
+                    help='CSV file with the distances between the stops, '
+                    'one row per stop. With --allocation=load, stops close '
+                    'to each other are not made busy at the same time')
+parser.add_argument('--anneal-steps', type=int, default=50000,
+                    help='Number of moves tried by --allocation=load')
+parser.add_argument('--shard-directory', type=str,
+                    help='Save every sheet and every stop in workbooks of '
+                    'their own in this directory instead of in one file')
+parser.add_argument('--workers', type=int, default=1,
+                    help='Number of processes saving the workbooks in '
+                    '--shard-directory')
+parser.add_argument('--dry-run', action='store_true',
+                    help='Only generate the sheets and print statistics. '
+                    'No workbook is written',
+                    default=False)
+parser.add_argument('--state', type=str,
+                    help='JSON file where the generated set is stored to '
+                    'be able to regenerate parts of it later')
+parser.add_argument('--regenerate-sheet', type=int, action='append',
+                    help='Replace this sheet in the set stored in --state '
+                    'using the clues already on the stops. The new sheet '
+                    'is saved in --filename')
+parser.add_argument('--regenerate-stop', type=int, action='append',
+                    help='Save this stop from the set stored in --state '
+                    'in --filename')
+parser.add_argument('--verify', action='store_true',
+                    help='Check that every clue gives the right value and '
+                    'that every sheet can be solved in only one way. The '
+                    'saved workbook is read back, or the generated set is '
+                    'checked with --dry-run and --shard-directory',
+                    default=False)
+parser.add_argument('--seed', type=int,
+                    help='Seed for the random numbers to be able to generate '
+                    'the same set again')
 parser.add_argument('--debug', '-d', action='store_true',
                     help='Activate trace outputs',
                     default=False)
 
-args = None
 
-CELL_ALIGNMENT = openpyxl.styles.Alignment(horizontal="center")
-CLUE_ALIGNMENT = openpyxl.styles.Alignment(horizontal="right")
-INTRO_ALIGNMENT = openpyxl.styles.Alignment(vertical="top",
-                                            wrap_text=True)
-
-CLUE_FONT = openpyxl.styles.Font(size=9, italic=True)
-VALUE_FONT = openpyxl.styles.Font(size=14, bold=True)
-CELL_SIDE = openpyxl.styles.Side(border_style="thin",
-                                 color='FF000000')
-BOX_SIDE = openpyxl.styles.Side(border_style="double",
-                                color='FF000000')
+@dataclasses.dataclass
+class SudokuConfig(object):
+    """The settings for generating a set of sheets and stops."""
+    sheets: int = 2
+    initial_values: int = 15
+    stops: int = 13
+    clue_letters: str = "ABCDEFGHIJKLMNOPQRSTUVWXYZ"
+    allocation: str = "simple"
+    distances: str = None
+    anneal_steps: int = 50000
+    debug: bool = False
+
+    @classmethod
+    def from_args(cls, args):
+        """Creates the config from the parsed command line."""
+        return cls(**{field.name: getattr(args, field.name)
+                      for field in dataclasses.fields(cls)})
+
+
+openpyxl = None
+
+# Held while openpyxl is imported and the styles are created.
+_openpyxl_lock = threading.Lock()
+
+
+def load_openpyxl():
+    """Import openpyxl and create the styles used in the workbook.
+
+    This is done first when something is written so that the sheets can
+    be generated without openpyxl. The lock keeps other threads waiting
+    until the styles are created.
+    """
+    global openpyxl, WriteOnlyCell, CellRange, CELL_ALIGNMENT, \
+        CLUE_ALIGNMENT, INTRO_ALIGNMENT, CLUE_FONT, VALUE_FONT, CELL_SIDE, \
+        BOX_SIDE
+    with _openpyxl_lock:
+        if openpyxl is not None:
+            return
+        import openpyxl
+        import openpyxl.styles
+        from openpyxl.cell import WriteOnlyCell
+        from openpyxl.worksheet.cell_range import CellRange
+
+        CELL_ALIGNMENT = openpyxl.styles.Alignment(horizontal="center")
+        CLUE_ALIGNMENT = openpyxl.styles.Alignment(horizontal="right")
+        INTRO_ALIGNMENT = openpyxl.styles.Alignment(vertical="top",
+                                                    wrap_text=True)
+
+        CLUE_FONT = openpyxl.styles.Font(size=9, italic=True)
+        VALUE_FONT = openpyxl.styles.Font(size=14, bold=True)
+        CELL_SIDE = openpyxl.styles.Side(border_style="thin",
+                                         color='FF000000')
+        BOX_SIDE = openpyxl.styles.Side(border_style="double",
+                                        color='FF000000')
 
 
 class Replacement(object):
@@ -93,6 +193,164 @@ class Replacement(object):
                             for key, value
                             in self._stops_for_clue.items()})
 
+    def for_entries(self, entries):
+        """Generate a new replacement with only the given entries."""
+        replacements = {entry: self._replacements[entry]
+                        for entry in entries
+                        if entry in self._replacements}
+        return Replacement(replacements,
+                           {clue: self._stops_for_clue[clue]
+                            for clue in replacements.values()
+                            if clue in self._stops_for_clue})
+
+
+class StreamingWorksheet(object):
+    """Gives the cell and merge_cells methods of a worksheet on top of
+    a write only worksheet.
+
+    The cells are kept until flush is called and are then written in
+    row order. No cells can be written in rows that are flushed.
+    """
+
+    def __init__(self, ws):
+        load_openpyxl()
+        self._ws = ws
+        self._rows = dict()     # row => {column: cell}
+        self._next_row = 1
+
+    def cell(self, row, column):
+        assert row >= self._next_row
+        cells = self._rows.setdefault(row, dict())
+        if column not in cells:
+            cells[column] = WriteOnlyCell(self._ws)
+        return cells[column]
+
+    def merge_cells(self, start_row, end_row, start_column, end_column):
+        self._ws.merged_cells.add(CellRange(min_row=start_row,
+                                            max_row=end_row,
+                                            min_col=start_column,
+                                            max_col=end_column))
+
+    def flush(self, end_row):
+        """Write all rows before end_row."""
+        for row in range(self._next_row, end_row):
+            cells = self._rows.pop(row, dict())
+            self._ws.append([cells.get(column)
+                             for column in range(1, 1 + max(cells,
+                                                            default=0))])
+        self._next_row = max(self._next_row, end_row)
+
+
+class SpilledSheets(object):
+    """Sheets stored in a temporary file.
+
+    Each board is stored as 81 unsigned shorts so the clue entries must
+    be renumbered to fit.
+    """
+
+    RECORD_SIZE = 9 * 9 * array.array('H').itemsize
+
+    def __init__(self):
+        self._file = tempfile.TemporaryFile()
+        self.count = 0
+
+    def append(self, sheet):
+        self._file.seek(0, 2)
+        self._file.write(sheet.to_bytes())
+        self.count += 1
+
+    def __iter__(self):
+        self._file.seek(0)
+        for _ in range(self.count):
+            yield Sheet.from_bytes(self._file.read(self.RECORD_SIZE))
+        self._file.seek(0, 2)
+
+    def close(self):
+        self._file.close()
+
+
+# Bit 1 << value is set for each value used.
+ALL_VALUES = 0b1111111110
+
+# No sudoku with fewer values than this has only one solution.
+MINIMUM_UNIQUE_VALUES = 17
+
+BOX_OF_CELL = [(pos // 27) * 3 + (pos % 9) // 3 for pos in range(9 * 9)]
+
+
+class BoardSolver(object):
+    """Solver for a board where only some of the values are known.
+
+    The values used in every row, column and box are kept as bit masks.
+    They are updated as cells are emptied so each check only searches
+    the empty cells instead of solving the board from the start.
+    """
+
+    def __init__(self, board, known):
+        """board holds the values of the cells and known their positions."""
+        self._board = board
+        self._rows = [0] * 9
+        self._columns = [0] * 9
+        self._boxes = [0] * 9
+        known = set(known)
+        self.empty = [pos for pos in range(9 * 9) if pos not in known]
+        for pos in known:
+            self._toggle(pos, 1 << board[pos])
+
+    def _toggle(self, pos, bit):
+        self._rows[pos // 9] ^= bit
+        self._columns[pos % 9] ^= bit
+        self._boxes[BOX_OF_CELL[pos]] ^= bit
+
+    def try_empty(self, pos):
+        """Empty the cell pos if the board still has only one solution.
+
+        Returns True if it was emptied."""
+        bit = 1 << self._board[pos]
+        self._toggle(pos, bit)
+        self.empty.append(pos)
+        # Any solution with another value in pos is a second solution.
+        if self._search(self.empty, 1, {pos: bit}):
+            self.empty.pop()
+            self._toggle(pos, bit)
+            return False
+        return True
+
+    def solutions(self, limit):
+        """Return the number of ways to fill the empty cells, at most limit."""
+        return self._search(list(self.empty), limit, dict())
+
+    def _search(self, empty, limit, excluded):
+        if not empty:
+            return 1
+        best = None
+        for index, pos in enumerate(empty):
+            candidates = (ALL_VALUES
+                          & ~(self._rows[pos // 9]
+                              | self._columns[pos % 9]
+                              | self._boxes[BOX_OF_CELL[pos]])
+                          & ~excluded.get(pos, 0))
+            count = bin(candidates).count("1")
+            if count == 0:
+                return 0
+            if best is None or count < best[0]:
+                best = (count, index, candidates)
+                if count == 1:
+                    break
+        _, index, candidates = best
+        empty[index], empty[-1] = empty[-1], empty[index]
+        pos = empty.pop()
+        found = 0
+        while candidates and found < limit:
+            bit = candidates & -candidates
+            candidates ^= bit
+            self._toggle(pos, bit)
+            found += self._search(empty, limit - found, excluded)
+            self._toggle(pos, bit)
+        empty.append(pos)
+        empty[index], empty[-1] = empty[-1], empty[index]
+        return found
+
 
 class Sheet(object):
     def _found_in_row(self, candidate, index):
@@ -125,7 +383,7 @@ class Sheet(object):
         if index >= 9 * 9:
             return True
         candidates = [c for c in range(1, 10)]
-        random.shuffle(candidates)
+        self._rng.shuffle(candidates)
         # import pdb; pdb.set_trace()
         for n in candidates:
             if self._found_in_row(n, index):
@@ -142,8 +400,14 @@ class Sheet(object):
                 return True
         return False
 
-    def __init__(self):
-        """Creates a fully filled sheet."""
+    def __init__(self, rng=None):
+        """Creates a fully filled sheet.
+
+        rng is the random.Random used for this sheet. A new one is used
+        if it is not given."""
+        if rng is None:
+            rng = random.Random()
+        self._rng = rng
         self._board = []
         self._fill_board(0)
         self.fully_filled_board = self._board.copy()
@@ -151,16 +415,69 @@ class Sheet(object):
     def __eq__(self, other):
         return self.fully_filled_board == other.fully_filled_board
 
-    def empty_random_cell(self):
-        pos = random.randint(0, 9 * 9 - 1)
-        if self._board[pos] == 0:
-            self.empty_random_cell()
-        self._board[pos] = 0
+    @classmethod
+    def from_bytes(cls, data):
+        """Creates a sheet from a board stored with to_bytes.
+
+        The fully filled board is not stored."""
+        sheet = cls.__new__(cls)
+        sheet._rng = random.Random()
+        sheet._board = array.array('H', data).tolist()
+        sheet.fully_filled_board = None
+        return sheet
+
+    def to_state(self):
+        return {"board": self._board,
+                "fully_filled_board": self.fully_filled_board}
+
+    @classmethod
+    def from_state(cls, state):
+        """Creates the sheet stored with to_state."""
+        sheet = cls.__new__(cls)
+        sheet._rng = random.Random()
+        sheet._board = state["board"]
+        sheet.fully_filled_board = state["fully_filled_board"]
+        return sheet
+
+    def to_bytes(self):
+        return array.array('H', self._board).tobytes()
+
+    def clue_entries(self):
+        return [entry for entry in self._board if entry > 9]
+
+    def move_entries(self, translation):
+        """Renumber the clue entries according to translation."""
+        self._board = [translation.get(entry, entry) for entry in self._board]
+
+    def plan(self, emptied, given):
+        """Empty cells and choose the values to keep on the sheet.
+
+        A cell is only emptied if the rest of the board can still be
+        filled in only one way. The given values are chosen so that they
+        alone are not enough to solve the board, if possible. Returns the
+        positions of the other values, to be replaced by clues, in random
+        order.
+        """
+        positions = list(range(9 * 9))
+        self._rng.shuffle(positions)
+        solver = BoardSolver(self._board, positions)
+        for pos in positions:
+            if len(solver.empty) == emptied:
+                break
+            solver.try_empty(pos)
+        for pos in solver.empty:
+            self._board[pos] = 0
+        filled = [pos for pos in positions if self._board[pos]]
+        if given < MINIMUM_UNIQUE_VALUES:
+            return filled[given:]
+        for attempt in range(10):
+            self._rng.shuffle(filled)
+            if BoardSolver(self._board, filled[:given]).solutions(2) > 1:
+                break
+        return filled[given:]
 
-    def replace_by(self, clue):
-        pos = random.randint(0, 9 * 9 - 1)
-        if self._board[pos] not in range(1, 10):
-            return self.replace_by(clue)
+    def replace_at(self, pos, clue):
+        """Replace the value in pos by clue. Returns the value."""
         value = self._board[pos]
         self._board[pos] = clue
         return value
@@ -228,6 +545,7 @@ class Sheet(object):
         Either clue or value is given. No lines within each cell.
         Thin lines around except for the box lines that are double size.
         """
+        load_openpyxl()
         ws.merge_cells(start_row=start_row, end_row=start_row,
                        start_column=1, end_column=9)
         ws.cell(row=start_row, column=1).value = sheet_identity
@@ -239,7 +557,7 @@ class Sheet(object):
         ws.cell(row=row, column=1).value = INTRO_TEXT_PER_SHEET
         ws.cell(row=row, column=1).alignment = INTRO_ALIGNMENT
 
-        row = start_row + 15
+        row = start_row + BOARD_ROW
         for line in range(9):
             line_borders = [{"top": CELL_SIDE}, {}, {"bottom": CELL_SIDE}]
             if line % 3 == 0:
@@ -275,20 +593,105 @@ class Sheet(object):
         assert row - start_row < ROWS_PER_SHEET
 
 
+class LoadAllocation(object):
+    """Moves heaps between the stops to spread the load of the teams.
+
+    The load of a stop is the number of clues looked up there and
+    VISIT_COST for every team that has to go there.
+    """
+
+    def __init__(self, heap_sheets, stop_of_heap, stops, weights=None):
+        """heap_sheets has a Counter sheet => entries for each heap."""
+        # heap => [(sheet, entries of the sheet in the heap), ...]
+        self._heaps = [sorted(h.items()) for h in heap_sheets]
+        self._sizes = [sum(h.values()) for h in heap_sheets]
+        self._stops = stops
+        self.stop_of_heap = list(stop_of_heap)
+        # stop => sheet => entries of the sheet on the stop
+        self._entries = [collections.Counter() for _ in range(stops)]
+        loads = [0] * stops
+        for heap, stop in enumerate(self.stop_of_heap):
+            for sheet, n in self._heaps[heap]:
+                if not self._entries[stop][sheet]:
+                    loads[stop] += VISIT_COST
+                self._entries[stop][sheet] += n
+            loads[stop] += self._sizes[heap]
+        self.crowding = Crowding(loads, weights)
+
+    def propose(self, rng):
+        """Returns (change of cost, move) for moving a random heap to
+        another stop or swapping the stops of two heaps."""
+        heap = rng.randrange(len(self._heaps))
+        old = self.stop_of_heap[heap]
+        if rng.random() < 0.5:
+            new = rng.randrange(self._stops - 1)
+            if new >= old:
+                new += 1
+            moves = [(heap, new)]
+        else:
+            other = rng.randrange(len(self._heaps))
+            new = self.stop_of_heap[other]
+            if new == old:
+                return 0, None
+            moves = [(heap, new), (other, old)]
+        # The second heap is looked at as if the first was moved.
+        undo = [(heap, self.stop_of_heap[heap]) for heap, _ in moves]
+        changes = collections.Counter()
+        for heap, new in moves:
+            changes.update(self._changes(heap, new))
+            self._move_entries(heap, new)
+        for heap, old in reversed(undo):
+            self._move_entries(heap, old)
+        return self.crowding.delta(changes), (moves, changes)
+
+    def _changes(self, heap, new):
+        """Returns the change of the loads if heap is moved to new."""
+        old = self.stop_of_heap[heap]
+        old_entries = self._entries[old]
+        new_entries = self._entries[new]
+        left = sum(1 for sheet, n in self._heaps[heap]
+                   if old_entries[sheet] == n)
+        arriving = sum(1 for sheet, _ in self._heaps[heap]
+                       if not new_entries[sheet])
+        size = self._sizes[heap]
+        return {old: -size - VISIT_COST * left,
+                new: size + VISIT_COST * arriving}
+
+    def _move_entries(self, heap, new):
+        old = self.stop_of_heap[heap]
+        for sheet, n in self._heaps[heap]:
+            self._entries[old][sheet] -= n
+            self._entries[new][sheet] += n
+        self.stop_of_heap[heap] = new
+
+    def apply(self, move):
+        moves, changes = move
+        for heap, new in moves:
+            self._move_entries(heap, new)
+        self.crowding.apply(changes)
+
+
 class SudokuGenerator(object):
     """Generator for the set of sheets and stops."""
 
     EMPTIED_CELLS = 10
 
-    def __init__(self, number_of_sheets, initial_values,
-                 number_of_stops,
-                 clue_letters):
-        self._number_of_sheets = number_of_sheets
+    def __init__(self, config, rng=None):
+        """Creates the generator.
+
+        config is a SudokuConfig and rng the random.Random used for
+        everything generated. A new one is used if it is not given."""
+        if rng is None:
+            rng = random.Random()
+        self._rng = rng
+        self._config = config
+        self._debug = config.debug
+        self._number_of_sheets = config.sheets
         self._number_of_clues_per_sheet = (9 * 9
                                            - self.EMPTIED_CELLS
-                                           - initial_values)
-        self._number_of_stops = number_of_stops
-        self._clue_letters = clue_letters
+                                           - config.initial_values)
+        self._number_of_stops = config.stops
+        self._clue_letters = config.clue_letters
 
         # Known weakness: If the clue_letters contains repeats
         # then this will not be enough and clue_generator will
@@ -302,16 +705,18 @@ class SudokuGenerator(object):
             print("Too many clues")
         self._used_clues = []
         self.sheets = []
+        self.sheets_generated = 0
 
         self._replacements = dict()        # value => [entry, ...]
         self._replacement_clues = dict()   # entry => clue
         self.stops = dict()                # stop# => [(clue, value), ...]
         self._stop_for_clue = dict()       # clue => stopindex
+        self.stop_loads = []               # stopindex => load
 
     def generate_clue(self):
         clue = ""
         for i in range(self._clue_length):
-            r = random.randint(0, len(self._clue_letters) - 1)
+            r = self._rng.randint(0, len(self._clue_letters) - 1)
             clue = clue + self._clue_letters[r]
         if clue in self._used_clues:
             return self.generate_clue()
@@ -323,22 +728,27 @@ class SudokuGenerator(object):
         Each stop is a list of clue => value pairs.
         Clues to replace the stop with is self._replacement_clues.
         On what stop each clue is is in self._stop_for_clue.
+        self.replacement is set to look them up.
         """
 
-        global args
-        heaps_per_stop = 7 ** (1/2)
+        load = self._config.allocation == "load"
+        if load:
+            sheet_of_entry = {entry: n
+                              for n, sheet in enumerate(self.sheets)
+                              for entry in sheet.clue_entries()}
         saved_heaps = dict()
         for entry, replacements in self._replacements.items():
-            random.shuffle(replacements)
+            self._rng.shuffle(replacements)
             heaps = []
-            for i in range(int(self._number_of_stops * heaps_per_stop)):
+            for i in range(self._heaps_per_value()):
                 heaps.append([])
             for replacement in replacements:
-                heaps[random.randint(0, len(heaps) - 1)].append(replacement)
+                heaps[self._rng.randint(0,
+                                        len(heaps) - 1)].append(replacement)
             heaps = sorted([x for x in heaps if x], key=len, reverse=True)
             saved_heaps[entry] = heaps
 
-        if args.debug:
+        if self._debug:
             print("Saved heaps:", saved_heaps)
             for key, value in saved_heaps.items():
                 print(key, len(value), end=': ')
@@ -346,72 +756,259 @@ class SudokuGenerator(object):
                     print(len(heap), end=' ')
                     print()
 
+        self._allocate_heaps([(heap, key, len(heap),
+                               collections.Counter(sheet_of_entry[entry]
+                                                   for entry in heap)
+                               if load else None)
+                              for key, value in saved_heaps.items()
+                              for heap in value])
+        self.replacement = Replacement(self._replacement_clues,
+                                       self._stop_for_clue)
+
+    def _heaps_per_value(self):
+        heaps_per_stop = 7 ** (1/2)
+        return int(self._number_of_stops * heaps_per_stop)
+
+    def _allocate_heaps(self, heaps):
+        """Allocate heaps to stops.
+
+        heaps is a list of (entries, value, size, sheets) tuples where
+        sheets is a Counter sheet => entries, only needed with the load
+        allocation. Each heap gets a clue and the
+        heaps are spread on the stops so that the stops get about the same
+        size. With the load allocation the heaps are then moved to spread
+        the load of the stops.
+        """
         saved_heaps_tuples = []
-        for key, value in saved_heaps.items():
-            for heap in value:
-                clue = self.generate_clue()
-                saved_heaps_tuples.append((heap, key, clue))
-                for entry in heap:
-                    self._replacement_clues[entry] = clue
+        for heap, key, size, sheets in heaps:
+            clue = self.generate_clue()
+            saved_heaps_tuples.append((heap, key, clue, size, sheets))
+            for entry in heap:
+                self._replacement_clues[entry] = clue
 
         # The value with the heap with most entries is first.
         saved_heaps_tuples = sorted(saved_heaps_tuples,
-                                    key=lambda x: len(x[0]),
+                                    key=lambda x: x[3],
                                     reverse=True)
-        if args.debug:
+        if self._debug:
             print("Saved heaps' tuples:", saved_heaps_tuples)
 
         stops_tuples = [[] for _ in range(self._number_of_stops)]
         while saved_heaps_tuples:
             # allocated it to the stop with the least entries
             stops_tuples = sorted(stops_tuples,
-                                  key=lambda x: sum([len(t[0]) for t in x]))
+                                  key=lambda x: sum([t[3] for t in x]))
             stops_tuples[0].append(saved_heaps_tuples.pop(0))
 
-        if args.debug:
+        stops_tuples = self._spread_load(stops_tuples)
+
+        if self._debug:
             print("Stops' tuples:", stops_tuples)
             for tuples in stops_tuples:
                 print("Heaps:", len(tuples),
-                      "Values:", sum([len(x[0]) for x in tuples]))
+                      "Values:", sum([x[3] for x in tuples]))
 
         # allocate one clue per heap
 
         self.stops = []
         for stop in stops_tuples:
             self.stops.append(sorted([(clue, value)
-                                      for heap, value, clue in stop]))
+                                      for heap, value, clue, size, sheets
+                                      in stop]))
 
-        random.shuffle(self.stops)
+        if not self._config.distances:
+            # The stop numbers only matter when the places are known.
+            self._rng.shuffle(self.stops)
         for n, stop in enumerate(self.stops):
             for clue, _ in stop:
                 self._stop_for_clue[clue] = n
 
+    def _spread_load(self, stops_tuples):
+        """Move the heaps in stops_tuples between the stops.
+
+        Only done with the load allocation. The load is kept in
+        self.stop_loads, without the visits for the simple allocation."""
+        if self._config.allocation != "load":
+            self.stop_loads = [sum(t[3] for t in stop)
+                               for stop in stops_tuples]
+            return stops_tuples
+        tuples = [t for stop in stops_tuples for t in stop]
+        stop_of_heap = [n for n, stop in enumerate(stops_tuples)
+                        for _ in stop]
+        weights = None
+        if self._config.distances:
+            weights = crowding_weights(read_distances(self._config.distances,
+                                                      self._number_of_stops))
+        allocation = LoadAllocation([t[4] for t in tuples], stop_of_heap,
+                                    self._number_of_stops, weights)
+        if self._number_of_stops > 1:
+            before = allocation.crowding.cost()
+            anneal(allocation, self._config.anneal_steps, self._rng)
+            if self._debug:
+                print("Crowding cost", before, "=>",
+                      allocation.crowding.cost())
+        self.stop_loads = allocation.crowding.loads
+        stops_tuples = [[] for _ in range(self._number_of_stops)]
+        for t, stop in zip(tuples, allocation.stop_of_heap):
+            stops_tuples[stop].append(t)
+        return stops_tuples
+
+    def _plan(self, sheet):
+        """Plan the sheet. Returns the positions to replace by clues."""
+        positions = sheet.plan(self.EMPTIED_CELLS, self._config.initial_values)
+        if self._debug and len(positions) != self._number_of_clues_per_sheet:
+            print("Sheet planned with", len(positions), "clues")
+        return positions
+
     def calculate(self):
         """Generate a set of sheets then move clues to stops."""
+        self.generate_sheets()
+        self.allocate_replacements_to_stops()
+
+    def generate_sheets(self):
+        """Generate the sheets and replace values by clue entries."""
         clue = 100
         for i in range(self._number_of_sheets):
 
-            sheet = Sheet()
+            sheet = Sheet(self._rng)
             if sheet in self.sheets:
                 print("That soduko is already seen")
                 # If this happens, it means that we will get fewer
                 # sheets than we actally wanted
                 continue
             self.sheets.append(sheet)
-            for c in range(self.EMPTIED_CELLS):
-                sheet.empty_random_cell()
-            for c in range(self._number_of_clues_per_sheet):
+            self.sheets_generated += 1
+            for pos in self._plan(sheet):
                 clue = clue + 1
-                value = sheet.replace_by(clue)
+                value = sheet.replace_at(pos, clue)
                 if value not in self._replacements:
                     self._replacements[value] = []
                 self._replacements[value].append(clue)
 
-        self.allocate_replacements_to_stops()
+    def regenerate_sheet(self, index):
+        """Replace the sheet index with a new one.
+
+        The clues of the new sheet are chosen among the ones already on
+        the stops so none of the stops change.
+        """
+        clues_for_value = dict()
+        for stop in self.stops:
+            for clue, value in stop:
+                clues_for_value.setdefault(value, []).append(clue)
+        sheet = Sheet(self._rng)
+        while sheet in self.sheets:
+            sheet = Sheet(self._rng)
+        entry = max(self._replacement_clues, default=100)
+        for pos in self._plan(sheet):
+            entry += 1
+            value = sheet.replace_at(pos, entry)
+            if value not in clues_for_value:
+                raise ValueError(f"No stop has a clue for {value}")
+            self._replacement_clues[entry] = self._rng.choice(
+                clues_for_value[value])
+        # The entries are shared by the sheets in a streaming set.
+        in_use = {entry
+                  for n, other in enumerate(self.sheets) if n != index
+                  for entry in other.clue_entries()}
+        for entry in set(self.sheets[index].clue_entries()) - in_use:
+            self._replacement_clues.pop(entry, None)
+        self.sheets[index] = sheet
         self.replacement = Replacement(self._replacement_clues,
                                        self._stop_for_clue)
 
-    def output_stop(self, ws, stop, stop_number, stop_identity, start_row):
+    def save_state(self, filename, sheets):
+        """Store the set in filename to be read with load_state.
+
+        sheets is self.sheets or the SpilledSheets. The sheets are written
+        one at a time so a streaming set is never all in memory."""
+        state = json.dumps({"config": dataclasses.asdict(self._config),
+                            "stops": self.stops,
+                            "replacements":
+                            list(self._replacement_clues.items()),
+                            "used_clues": self._used_clues})
+        with open(filename, "w") as f:
+            f.write('{"sheets": [')
+            for n, s in enumerate(sheets):
+                if n:
+                    f.write(", ")
+                json.dump(s.to_state(), f)
+            # The rest of the state follows the sheets in the same object.
+            f.write("], " + state[1:])
+
+    @classmethod
+    def load_state(cls, filename, rng=None):
+        """Creates the generator with the set stored with save_state."""
+        with open(filename) as f:
+            state = json.load(f)
+        gen = cls(SudokuConfig(**state["config"]), rng)
+        gen.sheets = [Sheet.from_state(s) for s in state["sheets"]]
+        gen.sheets_generated = len(gen.sheets)
+        gen.stops = [[tuple(pair) for pair in stop] for stop in state["stops"]]
+        gen._replacement_clues = dict(state["replacements"])
+        gen._used_clues = state["used_clues"]
+        for n, stop in enumerate(gen.stops):
+            for clue, _ in stop:
+                gen._stop_for_clue[clue] = n
+        gen.replacement = Replacement(gen._replacement_clues,
+                                      gen._stop_for_clue)
+        return gen
+
+    def calculate_streaming(self, spilled):
+        """Generate a set of sheets into spilled then move clues to stops.
+
+        Instead of remembering every replaced entry, each one is put in a
+        random heap directly and only the size of the heaps is kept. The
+        entries on the boards are renumbered to the heaps.
+        """
+        heaps_per_value = self._heaps_per_value()
+        heap_sizes = [0] * (9 * heaps_per_value)
+        heap_sheets = [None] * len(heap_sizes)
+        if self._config.allocation == "load":
+            heap_sheets = [collections.Counter() for _ in heap_sizes]
+        seen = set()
+        for i in range(self._number_of_sheets):
+
+            sheet = Sheet(self._rng)
+            key = hash(tuple(sheet.fully_filled_board))
+            if key in seen:
+                print("That soduko is already seen")
+                continue
+            seen.add(key)
+            translation = dict()
+            for c, pos in enumerate(self._plan(sheet)):
+                entry = 100 + c
+                value = sheet.replace_at(pos, entry)
+                heap = ((value - 1) * heaps_per_value
+                        + self._rng.randint(0, heaps_per_value - 1))
+                heap_sizes[heap] += 1
+                if heap_sheets[heap] is not None:
+                    heap_sheets[heap][self.sheets_generated] += 1
+                translation[entry] = 10 + heap
+            sheet.move_entries(translation)
+            spilled.append(sheet)
+            self.sheets_generated += 1
+
+        self._allocate_heaps([([10 + heap], 1 + heap // heaps_per_value, size,
+                               heap_sheets[heap])
+                              for heap, size in enumerate(heap_sizes)
+                              if size])
+        self.replacement = Replacement(self._replacement_clues,
+                                       self._stop_for_clue)
+
+    def print_statistics(self, seconds):
+        """Print a summary of the generated sheets and stops."""
+        print("Sheets:", self.sheets_generated,
+              "with", self._number_of_clues_per_sheet, "clues each")
+        clues = [len(stop) for stop in self.stops]
+        print("Clue codes per stop: min", min(clues), "max", max(clues))
+        print("Load per stop: min", min(self.stop_loads),
+              "max", max(self.stop_loads))
+        print("Clue code length:", self._clue_length)
+        print("Generated in", round(seconds, 2), "seconds")
+
+    @staticmethod
+    def output_stop(ws, stop, stop_number, stop_identity, start_row):
+        load_openpyxl()
         ws.merge_cells(start_row=start_row, end_row=start_row,
                        start_column=1, end_column=9)
         ws.cell(row=start_row, column=1).value = stop_identity
@@ -436,50 +1033,264 @@ class SudokuGenerator(object):
             ws.cell(row=row, column=column + 1).alignment = CELL_ALIGNMENT
 
 
-if __name__ == "__main__":
-    args = parser.parse_args()
+def read_workbook(filename):
+    """Returns the teams' view of the set saved in filename.
+
+    The result is (boards, stop_clues) where boards is a dict sheet
+    number => list of the 81 cells, each a value, a (stop number, clue)
+    tuple or None if empty, and stop_clues is a dict stop number =>
+    clue => value. The workbook is read one row at a time in read-only
+    mode.
+    """
+    load_openpyxl()
+    wb = openpyxl.load_workbook(filename, read_only=True)
+    boards, stop_clues = dict(), dict()
+    page = None
+    for row in wb.active.iter_rows(values_only=True):
+        first = row[0] if row else None
+        if isinstance(first, str) and first.startswith(HEADING_PER_SHEET):
+            page = boards.setdefault(int(first.split()[-1]), [None] * 81)
+            offset = 0
+        elif isinstance(first, str) and first.startswith(HEADING_PER_STOP):
+            page = stop_clues.setdefault(int(first.split()[-1]), dict())
+        elif isinstance(page, list):
+            offset += 1
+            line, part = divmod(offset - BOARD_ROW, 3)
+            if line not in range(9) or part == 2:
+                continue
+            for column, cell in enumerate(row[:9]):
+                if cell in (None, ""):
+                    continue
+                if part == 0:
+                    stop, _, clue = str(cell).rpartition(" ")
+                    cell = (int(stop) if stop else None, clue)
+                page[line * 9 + column] = cell
+        elif isinstance(page, dict):
+            for column, cell in enumerate(row[:-1]):
+                if isinstance(cell, str) and cell.endswith(" :"):
+                    page[cell[:-2]] = row[column + 1]
+    wb.close()
+    return boards, stop_clues
+
+
+def team_view(gen, sheets):
+    """Returns the teams' view of the generated set as read_workbook.
+
+    sheets is gen.sheets or the SpilledSheets."""
+    boards = dict()
+    for n, sheet in enumerate(sheets, start=1):
+        board = []
+        for entry in sheet._board:
+            if entry > 9:
+                stop = gen.replacement.get_stop(entry)
+                entry = (None if stop is None else stop + 1,
+                         gen.replacement.get_clue(entry))
+            board.append(entry or None)
+        boards[n] = board
+    return boards, {n: dict(stop) for n, stop in enumerate(gen.stops, start=1)}
+
+
+def verify_set(boards, stop_clues, solutions=None):
+    """Check the teams' view of a set, as returned by read_workbook.
+
+    Every clue must be on its stop, no value may be twice in a row,
+    column or box and each board must have only one solution. If the
+    solutions are given, as a dict sheet number => the fully filled
+    board, the values must also be the ones there. Returns a list of the
+    errors found.
+    """
+    errors = []
+    for n, board in sorted(boards.items()):
+        values = [0] * 81
+        for pos, cell in enumerate(board):
+            if isinstance(cell, tuple):
+                stop, clue = cell
+                value = stop_clues.get(stop, dict()).get(clue)
+                if value is None:
+                    errors.append(f"Sheet {n} cell {pos}: clue {clue} is "
+                                  f"not on stop {stop}")
+                    continue
+                cell = value
+            values[pos] = cell or 0
+        known = [pos for pos in range(81) if values[pos]]
+        used = [0] * 27
+        twice = False
+        for pos in known:
+            bit = 1 << values[pos]
+            for unit in (pos // 9, 9 + pos % 9, 18 + BOX_OF_CELL[pos]):
+                twice = twice or bool(used[unit] & bit)
+                used[unit] |= bit
+        if twice:
+            errors.append(f"Sheet {n}: a value is twice in a row, column "
+                          f"or box")
+            continue
+        solution = (solutions or dict()).get(n)
+        if solution and any(values[pos] != solution[pos] for pos in known):
+            errors.append(f"Sheet {n}: a value is not the right one")
+        if BoardSolver(values, known).solutions(2) != 1:
+            errors.append(f"Sheet {n}: there is not only one solution")
+    return errors
+
+
+def filled_boards(sheets):
+    """Returns the fully filled boards, if known, for verify_set."""
+    return {n: sheet.fully_filled_board
+            for n, sheet in enumerate(sheets, start=1)
+            if sheet.fully_filled_board}
+
+
+def check_numbers(option, numbers, count):
+    """Exit with a usage error unless all numbers are from 1 to count."""
+    for number in numbers or ():
+        if not 1 <= number <= count:
+            parser.error(f"{option} must be from 1 to {count}, not {number}")
+
+
+def regenerate(args):
+    """Replace the sheets args.regenerate_sheet in the set in args.state.
+
+    The new sheets and the stops args.regenerate_stop are saved in
+    args.filename.
+    """
+    gen = SudokuGenerator.load_state(args.state, random.Random(args.seed))
+    check_numbers("--regenerate-sheet", args.regenerate_sheet,
+                  len(gen.sheets))
+    check_numbers("--regenerate-stop", args.regenerate_stop, len(gen.stops))
+    for sheet_number in args.regenerate_sheet or ():
+        gen.regenerate_sheet(sheet_number - 1)
+
+    load_openpyxl()
+    wb = openpyxl.Workbook()
+    ws = wb.active
+
+    replacement = gen.replacement.move_stops(
+        {x: x + 1 for x in range(len(gen.stops))})
+    start_row = 1
+    for sheet_number in args.regenerate_sheet or ():
+        gen.sheets[sheet_number - 1].output(
+            ws, HEADING_PER_SHEET + " " + str(sheet_number),
+            start_row, replacement)
+        start_row = start_row + ROWS_PER_SHEET
+    for stop_number in args.regenerate_stop or ():
+        gen.output_stop(ws, gen.stops[stop_number - 1], stop_number,
+                        HEADING_PER_STOP + " " + str(stop_number),
+                        start_row)
+        start_row = start_row + ROWS_PER_SHEET
+
+    gen.save_state(args.state, gen.sheets)
+    wb.save(args.filename)
+    print('Saved output in', args.filename)
 
-    gen = SudokuGenerator(args.sheets, args.initial_values,
-                          args.stops,
-                          args.clue_letters)
 
-    gen.calculate()
-    print('Sheets:')
-    for s in gen.sheets:
-        s.print(gen.replacement)
+def main(argv=None):
+    """Generate a set from the command line arguments in argv."""
+    args = parser.parse_args(argv)
+
+    if args.regenerate_sheet or args.regenerate_stop:
+        if not args.state:
+            parser.error("--state is needed to regenerate")
+        regenerate(args)
+        return
+
+    gen = SudokuGenerator(SudokuConfig.from_args(args),
+                          random.Random(args.seed))
+
+    started = time.perf_counter()
+    if args.streaming:
+        sheets = SpilledSheets()
+        gen.calculate_streaming(sheets)
+    else:
+        gen.calculate()
+        sheets = gen.sheets
+
+    if args.dry_run:
+        gen.print_statistics(time.perf_counter() - started)
+        if args.verify:
+            boards, stop_clues = team_view(gen, sheets)
+            report(verify_set(boards, stop_clues, filled_boards(sheets)),
+                   len(boards))
+        return
+
+    if not args.streaming:
+        print('Sheets:')
+        for s in gen.sheets:
+            s.print(gen.replacement)
     print('Stops:')
     for n, s in enumerate(gen.stops):
         print(n, ", ".join([c+":"+str(con) for c, con in s]))
     print()
 
-    wb = openpyxl.Workbook()
-    ws = wb.active
-
     # Number the stops from 1 instead of from 0
     stop_number_translation = {x: y
                                for x, y
                                in enumerate(range(1, 1 + args.stops))}
     replacement = gen.replacement.move_stops(stop_number_translation)
 
-    start_row = 1  # In spreadsheet indexing this is the first
-    for n, s in enumerate(gen.sheets):
-        s.output(ws, HEADING_PER_SHEET + " " + str(1 + n),
-                 start_row, replacement)
-        start_row = start_row + ROWS_PER_SHEET
-
-    for n, s in enumerate(gen.stops):
-        stop_number = stop_number_translation[n]
-        gen.output_stop(ws, s, stop_number,
-                        HEADING_PER_STOP + " " + str(stop_number),
-                        start_row)
-        start_row = start_row + ROWS_PER_SHEET
+    if args.shard_directory:
+        def shards():
+            # The sheets are read one at a time so a streaming set stays
+            # in its spill file.
+            for n, s in enumerate(sheets):
+                yield ("sheet", 1 + n, s.output,
+                       (HEADING_PER_SHEET + " " + str(1 + n), 1,
+                        replacement.for_entries(s.clue_entries())))
+            for n, s in enumerate(gen.stops):
+                stop_number = stop_number_translation[n]
+                yield ("stop", stop_number, gen.output_stop,
+                       (s, stop_number,
+                        HEADING_PER_STOP + " " + str(stop_number), 1))
+        save_shards(args.shard_directory, shards(), args.workers)
+    else:
+        if args.streaming:
+            load_openpyxl()
+            wb = openpyxl.Workbook(write_only=True)
+            ws = StreamingWorksheet(wb.create_sheet())
+        else:
+            load_openpyxl()
+            wb = openpyxl.Workbook()
+            ws = wb.active
+
+        start_row = 1  # In spreadsheet indexing this is the first
+        for n, s in enumerate(sheets):
+            s.output(ws, HEADING_PER_SHEET + " " + str(1 + n),
+                     start_row, replacement)
+            start_row = start_row + ROWS_PER_SHEET
+            if args.streaming:
+                ws.flush(start_row)
+
+        for n, s in enumerate(gen.stops):
+            stop_number = stop_number_translation[n]
+            gen.output_stop(ws, s, stop_number,
+                            HEADING_PER_STOP + " " + str(stop_number),
+                            start_row)
+            start_row = start_row + ROWS_PER_SHEET
+            if args.streaming:
+                ws.flush(start_row)
+
+        wb.save(args.filename)
+
+    if args.state:
+        gen.save_state(args.state, sheets)
+
+    if args.verify:
+        if args.shard_directory:
+            boards, stop_clues = team_view(gen, sheets)
+        else:
+            boards, stop_clues = read_workbook(args.filename)
+        report(verify_set(boards, stop_clues, filled_boards(sheets)),
+               len(boards))
 
-    wb.save(args.filename)
+    if args.streaming:
+        sheets.close()
 
-    print('Saved output in', args.filename)
+    print('Saved output in', args.shard_directory or args.filename)
     print('To print,')
     print('1. open in Excel or LibreOffice Calc,')
     print('2. adjust page size so that all 9 columns of each sudoku is seen')
     print('   and so that the pages has the right height (the first line on')
     print('   every page is in the same place)')
     print('3. Print (or export to pdf)')
+
+
+if __name__ == "__main__":
+    main()
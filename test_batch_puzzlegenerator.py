@@ -0,0 +1,51 @@
+#!/usr/bin/env python3
+
+import contextlib
+import io
+import os
+import tempfile
+import unittest
+from batch_puzzlegenerator import check_files, job_arguments, run_jobs
+
+
+class JobArgumentsTestCase(unittest.TestCase):
+    def testOptionsAreTranslated(self):
+        job = {"name": "a", "type": "sudoku", "sheets": 4,
+               "clue_letters": "ABC", "streaming": True, "debug": False,
+               "filename": "a.xlsx"}
+        self.assertListEqual(job_arguments(job, "out"),
+                             ["--sheets", "4",
+                              "--clue-letters", "ABC",
+                              "--streaming",
+                              "--filename", "out/a.xlsx"])
+
+    def testFilenameDefaultsToName(self):
+        job = {"name": "b", "type": "mastermind", "sheets": 2}
+        self.assertListEqual(job_arguments(job, "out"),
+                             ["--sheets", "2", "--filename", "out/b.xlsx"])
+
+    def testSameFileInTwoJobsIsRejected(self):
+        jobs = [{"name": "a", "type": "sudoku", "state": "s.json"},
+                {"name": "b", "type": "mastermind", "state": "s.json"}]
+        with self.assertRaises(ValueError):
+            check_files(jobs, "out")
+        jobs[1]["state"] = "t.json"
+        check_files(jobs, "out")
+
+
+class RunJobsTestCase(unittest.TestCase):
+    def testFailingJobIsReported(self):
+        jobs = [{"name": "bad", "type": "sudoku", "bogus": 3},
+                {"name": "good", "type": "sudoku", "sheets": 1,
+                 "filename": "good.xlsx", "state": "good.json"}]
+        with tempfile.TemporaryDirectory() as directory:
+            with contextlib.redirect_stderr(io.StringIO()):
+                results = run_jobs(jobs, 1, directory, False)
+            self.assertTrue(os.path.exists(os.path.join(directory,
+                                                        "good.json")))
+        self.assertTrue(results[0]["status"].startswith("failed"))
+        self.assertEqual(results[1]["status"], "ok")
+
+
+if __name__ == '__main__':
+    unittest.main()
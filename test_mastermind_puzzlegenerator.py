@@ -1,7 +1,14 @@
 #!/usr/bin/env python3
 
+import itertools
+import os
+import random
+import tempfile
 import unittest
-from mastermind_puzzlegenerator import Sheet
+from mastermind_puzzlegenerator import Sheet, FeedbackIndex, \
+    MinimalClueSearch, Stops, answer_matrix, generate_sheets, \
+    MastermindConfig, allocate_stops, feedback_classes, save_state, \
+    load_state, main, read_workbook, regenerate_sheet, team_view, verify_set
 
 
 class SheetTestCase(unittest.TestCase):
@@ -16,7 +23,7 @@ class SheetTestCase(unittest.TestCase):
                          clue_lines=None,
                          clue_answers=None,
                          easy=False):
-                self.args = A()
+                self.config = A()
                 self.correct = correct
                 self.clue_lines = clue_lines
                 self.clue_answers = clue_answers
@@ -25,7 +32,7 @@ class SheetTestCase(unittest.TestCase):
         self.sheet = S()
 
     def testAnswerCorrectLocationBlacks(self):
-        self.sheet.args.columns = 4
+        self.sheet.config.columns = 4
         self.sheet.correct = [1, 2, 3, 4]
         self.assertTupleEqual(self.sheet.answer([1, 2, 3, 4]), (4, 0,))
         self.assertTupleEqual(self.sheet.answer([1, 2, 3, 5]), (3, 0,))
@@ -35,7 +42,7 @@ class SheetTestCase(unittest.TestCase):
         self.assertTupleEqual(self.sheet.answer([5, 6, 7, 4]), (1, 0,))
 
     def testAnswerIncorrectLocationWhites(self):
-        self.sheet.args.columns = 4
+        self.sheet.config.columns = 4
         self.sheet.correct = [1, 2, 3, 4]
         self.assertTupleEqual(self.sheet.answer([4, 1, 2, 3]), (0, 4,))
         self.assertTupleEqual(self.sheet.answer([5, 1, 2, 3]), (0, 3,))
@@ -49,7 +56,7 @@ class SheetTestCase(unittest.TestCase):
         self.assertTupleEqual(self.sheet.answer(first), result)
 
     def testAnswerMultiValuesInCorrect(self):
-        self.sheet.args.columns = 4
+        self.sheet.config.columns = 4
         first = [1, 1, 1, 1]
         self.assertBothWays(first, [1, 1, 1, 1], (4, 0,))
         self.assertBothWays(first, [1, 1, 1, 2], (3, 0,))
@@ -63,18 +70,282 @@ class SheetTestCase(unittest.TestCase):
         self.assertBothWays(first, [2, 3, 4, 1], (0, 2,))
 
     def testSimplerAnswers(self):
-        self.sheet.args.columns = 2
+        self.sheet.config.columns = 2
         first = [1, 2]
         self.assertBothWays(first, [1, 2], (2, 0,))
 
     def testCombinations(self):
-        self.sheet.args.columns = 2
-        self.sheet.args.colors = 2
-        self.sheet.args.debug = True
+        self.sheet.config.columns = 2
+        self.sheet.config.colors = 2
+        self.sheet.config.debug = True
         self.sheet.correct = [1, 2]
         self.assertEqual(self.sheet.combinations([]), 4)
         self.assertEqual(self.sheet.combinations([[1, 3]]), 2)
 
+    def testCombinationsMatchEnumeration(self):
+        self.sheet.config.columns = 4
+        self.sheet.config.colors = 5
+        self.sheet.correct = [2, 2, 5, 1]
+        clue_lines = [[1, 2, 3, 4], [2, 5, 5, 2], [3, 3, 4, 4], [1, 1, 2, 5]]
+        for n in range(len(clue_lines) + 1):
+            count = 0
+            for line in itertools.product(range(1, 6), repeat=4):
+                if all(self.sheet.answer(clue_line, list(line))
+                       == self.sheet.answer(clue_line)
+                       for clue_line in clue_lines[:n]):
+                    count += 1
+            self.assertEqual(self.sheet.combinations(clue_lines[:n]), count)
+
+
+class SeededGenerationTestCase(unittest.TestCase):
+    def testSameSeedGivesSameSheets(self):
+        config = MastermindConfig(sheets=3, easy=1, columns=3, colors=5,
+                                  stops=8)
+        first = [Sheet(config, True, random.Random(17)) for _ in range(2)]
+        self.assertListEqual(first[0].correct, first[1].correct)
+        self.assertListEqual(first[0].clue_lines, first[1].clue_lines)
+
+    def testSeededParallelGeneration(self):
+        config = MastermindConfig(sheets=3, columns=3, colors=5, stops=8)
+        first = list(generate_sheets(config, 2, 2, random.Random(3)))
+        second = list(generate_sheets(config, 2, 2, random.Random(3)))
+        self.assertListEqual([s.clue_lines for s in first],
+                             [s.clue_lines for s in second])
+
+    def testSameSheetsWithOneAndTwoWorkers(self):
+        config = MastermindConfig(sheets=3, easy=1, columns=3, colors=5,
+                                  stops=8)
+        serial = list(generate_sheets(config, 1, 2, random.Random(4)))
+        pooled = list(generate_sheets(config, 2, 2, random.Random(4)))
+        self.assertListEqual([s.to_state() for s in serial],
+                             [s.to_state() for s in pooled])
+
+
+class AnswerMatrixTestCase(unittest.TestCase):
+    def setUp(self):
+        class A(object):
+            debug = False
+            columns = 4
+            colors = 8
+            stops = 3
+            sheets = 2
+
+        self.config = A()
+
+    def testMatrixMatchesAnswer(self):
+        sheet = Sheet.__new__(Sheet)
+        sheet.config = self.config
+        corrects = [[1, 2, 3, 4], [1, 1, 2, 2]]
+        clue_lines = [[[4, 1, 2, 3], [1, 2, 5, 5], [5, 6, 7, 8]],
+                      [[1, 1, 1, 2], [2, 3, 4, 1], [1, 1, 2, 2]]]
+        matrix = answer_matrix(self.config, corrects, clue_lines)
+        for correct, lines, answers in zip(corrects, clue_lines, matrix):
+            for line, answer in zip(lines, answers):
+                self.assertTupleEqual(answer, sheet.answer(line, correct))
+
+    def testAddAnswersOneCluePerAnswer(self):
+        stops = Stops(self.config)
+        stops.add_answers([[(0, 4), (2, 0), (0, 0)],
+                           [(0, 4), (1, 1), (0, 0)]])
+        self.assertEqual(len(stops.stop_infos[1]), 1)
+        self.assertEqual(len(stops.stop_infos[2]), 2)
+        self.assertEqual(stops.generate_clue(2, (1, 1)),
+                         stops.stop_infos[2][(1, 1)])
+
+
+class GenerateSheetsTestCase(unittest.TestCase):
+    def testSheetsInOrder(self):
+        config = MastermindConfig(sheets=5, easy=2, columns=3, colors=4)
+        sheets = list(generate_sheets(config, 2, 1))
+        self.assertListEqual([s.easy for s in sheets],
+                             [True, True, False, False, False])
+        for s in sheets:
+            self.assertEqual(len(s.clue_lines), config.stops)
+
+
+class StopsTestCase(unittest.TestCase):
+    def testFeedbackClasses(self):
+        classes = feedback_classes(4)
+        self.assertEqual(len(classes), 14)
+        self.assertNotIn((3, 1), classes)
+        self.assertIn((4, 0), classes)
+        self.assertIn((0, 0), classes)
+
+    def testCluesAreUnique(self):
+        config = MastermindConfig(stops=5)
+        stops = Stops(config, random.Random(1))
+        clues = [stops.generate_clue(stop, answer)
+                 for stop in range(1, 6)
+                 for answer in feedback_classes(4)]
+        self.assertEqual(len(set(clues)), len(clues))
+        self.assertEqual(len(stops.stop_infos[3]), 14)
+
+
+class AllocateStopsTestCase(unittest.TestCase):
+    def testTeamsAreSpreadOverTheStops(self):
+        config = MastermindConfig(sheets=12, columns=3, colors=5, stops=6,
+                                  allocation="load", anneal_steps=5000)
+        rng = random.Random(3)
+        sheets = [Sheet(config, rng=rng) for _ in range(config.sheets)]
+        allocate_stops(config, sheets, rng)
+        for s in sheets:
+            self.assertListEqual(sorted(s.stop_numbers), [1, 2, 3, 4, 5, 6])
+        for numbers in zip(*(s.stop_numbers for s in sheets)):
+            self.assertLessEqual(max(numbers.count(n) for n in numbers), 3)
+
+    def testAnswersAreAddedToTheStopOfTheLine(self):
+        config = MastermindConfig(columns=3, stops=3)
+        stops = Stops(config)
+        stops.add_answers([[(0, 0), (1, 0), (2, 0)]], [[3, 1, 2]])
+        self.assertDictEqual({stop: list(infos)
+                              for stop, infos in stops.stop_infos.items()},
+                             {1: [(1, 0)], 2: [(2, 0)], 3: [(0, 0)]})
+
+
+class StateTestCase(unittest.TestCase):
+    def testStoredSetIsReadBack(self):
+        config = MastermindConfig(sheets=2, easy=1, columns=3, colors=5,
+                                  stops=6)
+        rng = random.Random(5)
+        stops = Stops(config, rng)
+        sheets = [Sheet(config, index < config.easy, rng)
+                  for index in range(config.sheets)]
+        stops.add_answers(answer_matrix(config,
+                                        [s.correct for s in sheets],
+                                        [s.clue_lines for s in sheets]))
+        with tempfile.TemporaryDirectory() as directory:
+            filename = os.path.join(directory, "state.json")
+            save_state(filename, config, sheets, stops)
+            read_config, read_sheets, read_stops = load_state(filename)
+        self.assertEqual(read_config, config)
+        self.assertListEqual([s.to_state() for s in read_sheets],
+                             [s.to_state() for s in sheets])
+        self.assertDictEqual(read_stops.stop_infos, stops.stop_infos)
+        self.assertEqual(read_stops.generate_clue(2, (0, 0)),
+                         stops.generate_clue(2, (0, 0)))
+
+
+class RegenerateSheetTestCase(unittest.TestCase):
+    def testNewSheetReusesAnswersOnTheStops(self):
+        config = MastermindConfig(sheets=6, columns=3, colors=5, stops=6)
+        rng = random.Random(4)
+        stops = Stops(config, rng)
+        sheets = [Sheet(config, rng=rng) for _ in range(config.sheets)]
+        stops.add_answers(answer_matrix(config,
+                                        [s.correct for s in sheets],
+                                        [s.clue_lines for s in sheets]))
+        s = regenerate_sheet(config, sheets[0], stops, rng)
+        self.assertListEqual(s.stop_numbers, sheets[0].stop_numbers)
+        new = [line for line, (stop_number, answer)
+               in enumerate(zip(s.stop_numbers, s.clue_answers))
+               if not stops.is_used(stop_number, answer)]
+        self.assertListEqual(new, [])
+
+    def testNumbersOutsideTheSetAreRejected(self):
+        with tempfile.TemporaryDirectory() as directory:
+            state = os.path.join(directory, "state.json")
+            filename = os.path.join(directory, "mm.xlsx")
+            main(['--sheets', '2', '--columns', '3', '--colors', '5',
+                  '--stops', '6', '--seed', '1', '--state', state,
+                  '--filename', filename])
+            for option, number in [('--regenerate-sheet', '0'),
+                                   ('--regenerate-sheet', '3'),
+                                   ('--regenerate-stop', '-1'),
+                                   ('--regenerate-stop', '7')]:
+                with self.assertRaises(SystemExit):
+                    main(['--state', state, option, number,
+                          '--filename', filename])
+
+
+class VerifyTestCase(unittest.TestCase):
+    def setUp(self):
+        self.config = MastermindConfig(sheets=3, columns=3, colors=5,
+                                       stops=6)
+        rng = random.Random(8)
+        self.stops = Stops(self.config, rng)
+        self.sheets = [Sheet(self.config, rng=rng) for _ in range(3)]
+        self.stops.add_answers(
+            answer_matrix(self.config,
+                          [s.correct for s in self.sheets],
+                          [s.clue_lines for s in self.sheets]))
+
+    def testGeneratedSetIsCorrect(self):
+        self.assertListEqual(verify_set(self.config,
+                                        *team_view(self.sheets, self.stops)),
+                             [])
+
+    def testWrongAnswerOnStopIsFound(self):
+        lines, corrects, stop_clues = team_view(self.sheets, self.stops)
+        stop_number, _, clue = lines[2][0]
+        blacks, whites = stop_clues[stop_number][clue]
+        stop_clues[stop_number][clue] = (blacks, whites + 1)
+        errors = verify_set(self.config, lines, corrects, stop_clues)
+        self.assertTrue(any(error.startswith("Sheet 2 line 1:")
+                            for error in errors))
+
+    def testSetSolvedWithoutCluesIsCorrect(self):
+        config = MastermindConfig(sheets=2, columns=1, colors=1, stops=1)
+        rng = random.Random(1)
+        stops = Stops(config, rng)
+        sheets = [Sheet(config, rng=rng) for _ in range(config.sheets)]
+        stops.add_answers(answer_matrix(config,
+                                        [s.correct for s in sheets],
+                                        [s.clue_lines for s in sheets]))
+        self.assertListEqual([s.solvable for s in sheets], [0, 0])
+        self.assertListEqual(verify_set(config,
+                                        *team_view(sheets, stops)), [])
+
+    def testSavedWorkbookIsReadBack(self):
+        with tempfile.TemporaryDirectory() as directory:
+            filename = os.path.join(directory, "mm.xlsx")
+            main(['--sheets', '3', '--columns', '3', '--colors', '5',
+                  '--stops', '6', '--seed', '2', '--filename', filename])
+            lines, corrects, stop_clues = read_workbook(filename, self.config)
+        self.assertListEqual(sorted(lines), [1, 2, 3])
+        self.assertEqual(len(lines[1]), 6)
+        self.assertListEqual(verify_set(self.config, lines, corrects,
+                                        stop_clues), [])
+
+
+class MinimalClueSearchTestCase(unittest.TestCase):
+    def setUp(self):
+        class A(object):
+            debug = False
+            columns = 3
+            colors = 4
+            stops = 10
+            search_width = 0
+            processes = 1
+
+        self.config = A()
+
+    def testPartitionMatchesAnswer(self):
+        sheet = Sheet.__new__(Sheet)
+        sheet.config = self.config
+        index = FeedbackIndex(self.config)
+        clue_line = [1, 1, 2]
+        partition = index.partition(clue_line)
+        for line in index.lines:
+            answer = sheet.answer(clue_line, line)
+            self.assertTrue(partition[answer] & index.bit(line))
+
+    def testSearchIdentifiesCode(self):
+        correct = [1, 2, 3]
+        lines, answers = MinimalClueSearch(self.config, correct).search()
+        index = FeedbackIndex(self.config)
+        remaining = index.all
+        for line, answer in zip(lines, answers):
+            found, mask = index.consistent(line, correct)
+            self.assertEqual(found, answer)
+            remaining &= mask
+        self.assertEqual(remaining, index.bit(correct))
+
+    def testSearchEasyHasBlacks(self):
+        lines, answers = MinimalClueSearch(self.config, [4, 4, 1],
+                                           easy=True).search()
+        for answer in answers:
+            self.assertGreater(answer[0], 0)
+
 
 if __name__ == '__main__':
     unittest.main()
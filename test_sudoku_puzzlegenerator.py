@@ -0,0 +1,184 @@
+#!/usr/bin/env python3
+
+import collections
+import os
+import random
+import tempfile
+import unittest
+from sudoku_puzzlegenerator import BoardSolver, LoadAllocation, \
+    Replacement, Sheet, SpilledSheets, SudokuConfig, SudokuGenerator, \
+    filled_boards, main, read_workbook, team_view, verify_set
+
+
+class SpilledSheetsTestCase(unittest.TestCase):
+    def testStoredSheetsAreReadBack(self):
+        spilled = SpilledSheets()
+        sheets = [Sheet(), Sheet()]
+        sheets[0].move_entries({sheets[0]._board[0]: 300})
+        for sheet in sheets:
+            spilled.append(sheet)
+        for sheet, read in zip(sheets, spilled):
+            self.assertListEqual(read._board, sheet._board)
+        self.assertEqual(len(list(spilled)), 2)
+        spilled.close()
+
+
+class ReplacementTestCase(unittest.TestCase):
+    def testForEntriesKeepsOnlyThoseEntries(self):
+        replacement = Replacement({101: "AB", 102: "CD", 103: "AB"},
+                                  {"AB": 1, "CD": 2})
+        restricted = replacement.for_entries([5, 103])
+        self.assertEqual(restricted.get_clue(103), "AB")
+        self.assertEqual(restricted.get_stop(103), 1)
+        self.assertIsNone(restricted.get_clue(102))
+        self.assertIsNone(restricted.get_clue(5))
+
+
+class PlanTestCase(unittest.TestCase):
+    def setUp(self):
+        self.sheet = Sheet(random.Random(7))
+        self.clue_positions = self.sheet.plan(10, 15)
+
+    def testPlanHitsTheCounts(self):
+        self.assertEqual(self.sheet._board.count(0), 10)
+        self.assertEqual(len(self.clue_positions), 81 - 10 - 15)
+
+    def testPlannedSheetHasOneSolution(self):
+        known = [pos for pos in range(81) if self.sheet._board[pos]]
+        solver = BoardSolver(self.sheet.fully_filled_board, known)
+        self.assertEqual(solver.solutions(2), 1)
+
+    def testGivenValuesAloneAreNotEnough(self):
+        given = [pos for pos in range(81)
+                 if self.sheet._board[pos] and pos not in self.clue_positions]
+        self.assertEqual(BoardSolver(self.sheet._board, given).solutions(2), 2)
+
+
+class LoadAllocationTestCase(unittest.TestCase):
+    def testCostIsKeptUpToDate(self):
+        rng = random.Random(4)
+        heap_sheets = [collections.Counter(rng.randrange(10)
+                                           for _ in range(rng.randint(1, 6)))
+                       for _ in range(30)]
+        allocation = LoadAllocation(heap_sheets,
+                                    [rng.randrange(5) for _ in heap_sheets],
+                                    5)
+        cost = allocation.crowding.cost()
+        for _ in range(500):
+            delta, move = allocation.propose(rng)
+            if move is not None:
+                allocation.apply(move)
+                cost += delta
+        again = LoadAllocation(heap_sheets, allocation.stop_of_heap, 5)
+        self.assertListEqual(allocation.crowding.loads, again.crowding.loads)
+        self.assertAlmostEqual(cost, again.crowding.cost())
+
+
+class SudokuGeneratorTestCase(unittest.TestCase):
+    def testSameSeedGivesSameSet(self):
+        config = SudokuConfig(sheets=2, stops=5)
+        generators = [SudokuGenerator(config, random.Random(11))
+                      for _ in range(2)]
+        for gen in generators:
+            gen.calculate()
+        self.assertListEqual([s._board for s in generators[0].sheets],
+                             [s._board for s in generators[1].sheets])
+        self.assertListEqual(generators[0].stops, generators[1].stops)
+
+    def testEveryClueIsOnAStop(self):
+        config = SudokuConfig(sheets=2, stops=5)
+        gen = SudokuGenerator(config, random.Random(12))
+        gen.calculate()
+        for sheet in gen.sheets:
+            for entry in sheet.clue_entries():
+                self.assertIn(gen.replacement.get_stop(entry), range(5))
+
+    def testEveryClueIsOnAStopWithLoadAllocation(self):
+        config = SudokuConfig(sheets=3, stops=5, allocation="load",
+                              anneal_steps=2000)
+        gen = SudokuGenerator(config, random.Random(14))
+        gen.calculate()
+        for sheet in gen.sheets:
+            for entry in sheet.clue_entries():
+                self.assertIn(gen.replacement.get_stop(entry), range(5))
+        self.assertLessEqual(max(gen.stop_loads) - min(gen.stop_loads), 2)
+
+    def testRegeneratedSheetUsesTheSameStops(self):
+        config = SudokuConfig(sheets=3, stops=5)
+        gen = SudokuGenerator(config, random.Random(13))
+        gen.calculate()
+        stops = [list(stop) for stop in gen.stops]
+        old = gen.sheets[1]
+        gen.regenerate_sheet(1)
+        self.assertListEqual(gen.stops, stops)
+        self.assertFalse(gen.sheets[1] == old)
+        value_for_clue = {clue: value
+                          for stop in gen.stops for clue, value in stop}
+        sheet = gen.sheets[1]
+        for pos, entry in enumerate(sheet._board):
+            if entry > 9:
+                clue = gen.replacement.get_clue(entry)
+                self.assertEqual(value_for_clue[clue],
+                                 sheet.fully_filled_board[pos])
+
+
+class RegenerateTestCase(unittest.TestCase):
+    def testRegenerateInStreamingState(self):
+        with tempfile.TemporaryDirectory() as directory:
+            state = os.path.join(directory, "state.json")
+            main(['--sheets', '4', '--stops', '5', '--seed', '1',
+                  '--streaming', '--state', state,
+                  '--filename', os.path.join(directory, "sudoku.xlsx")])
+            main(['--state', state, '--regenerate-sheet', '2',
+                  '--filename', os.path.join(directory, "new.xlsx")])
+            gen = SudokuGenerator.load_state(state)
+        self.assertListEqual(verify_set(*team_view(gen, gen.sheets)), [])
+
+    def testNumbersOutsideTheSetAreRejected(self):
+        with tempfile.TemporaryDirectory() as directory:
+            state = os.path.join(directory, "state.json")
+            filename = os.path.join(directory, "sudoku.xlsx")
+            main(['--sheets', '2', '--stops', '5', '--seed', '1',
+                  '--state', state, '--filename', filename])
+            for option, number in [('--regenerate-sheet', '0'),
+                                   ('--regenerate-sheet', '3'),
+                                   ('--regenerate-stop', '-1'),
+                                   ('--regenerate-stop', '6')]:
+                with self.assertRaises(SystemExit):
+                    main(['--state', state, option, number,
+                          '--filename', filename])
+
+
+class VerifyTestCase(unittest.TestCase):
+    def setUp(self):
+        self.gen = SudokuGenerator(SudokuConfig(sheets=3, stops=5),
+                                   random.Random(15))
+        self.gen.calculate()
+
+    def testGeneratedSetIsCorrect(self):
+        boards, stop_clues = team_view(self.gen, self.gen.sheets)
+        self.assertListEqual(verify_set(boards, stop_clues,
+                                        filled_boards(self.gen.sheets)), [])
+
+    def testWrongValueOnStopIsFound(self):
+        boards, stop_clues = team_view(self.gen, self.gen.sheets)
+        stop, clue = next(cell for cell in boards[2]
+                          if isinstance(cell, tuple))
+        stop_clues[stop][clue] = stop_clues[stop][clue] % 9 + 1
+        self.assertTrue(verify_set(boards, stop_clues,
+                                   filled_boards(self.gen.sheets)))
+
+    def testSavedWorkbookIsReadBack(self):
+        with tempfile.TemporaryDirectory() as directory:
+            filename = os.path.join(directory, "sudoku.xlsx")
+            main(['--sheets', '2', '--stops', '4', '--seed', '3',
+                  '--filename', filename])
+            boards, stop_clues = read_workbook(filename)
+        self.assertListEqual(sorted(boards), [1, 2])
+        self.assertListEqual(sorted(stop_clues), [1, 2, 3, 4])
+        self.assertEqual(boards[1].count(None), 10)
+        self.assertListEqual(verify_set(boards, stop_clues), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
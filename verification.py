@@ -0,0 +1,16 @@
+"""Reports the result of verifying a generated set."""
+
+
+class VerificationFailed(Exception):
+    pass
+
+
+def report(errors, sheets):
+    """Print the errors found when verifying a set of sheets.
+
+    Raises VerificationFailed if there are any."""
+    for error in errors:
+        print(error)
+    if errors:
+        raise VerificationFailed(f"{len(errors)} errors found")
+    print("Verified", sheets, "sheets")
@@ -0,0 +1,57 @@
+"""Saves the pages of a set in workbooks of their own.
+
+Each sheet, stop or other page is a shard saved in its own workbook so
+that they can be saved by several processes and printed one by one. An
+index.json file lists the workbooks.
+"""
+
+import collections
+import concurrent.futures
+import json
+import os
+
+
+def _save_shard(job):
+    import openpyxl
+    filename, output, output_args = job
+    wb = openpyxl.Workbook()
+    output(wb.active, *output_args)
+    wb.save(filename)
+
+
+def save_shards(directory, shards, workers):
+    """Save each shard in a workbook of its own in directory.
+
+    shards is an iterable of (kind, number, output, output_args) where
+    output is called as output(ws, *output_args) to fill the worksheet.
+    The number is None for a kind with only one shard. The workbooks are
+    saved by workers processes. shards is read as the workbooks are saved
+    so at most two shards per worker are held at a time. index.json in
+    directory lists the workbooks.
+    """
+    os.makedirs(directory, exist_ok=True)
+    index = []
+
+    def jobs():
+        for kind, number, output, output_args in shards:
+            filename = kind + ".xlsx"
+            if number is not None:
+                filename = f"{kind}-{number}.xlsx"
+            index.append({"kind": kind, "number": number,
+                          "filename": filename})
+            yield os.path.join(directory, filename), output, output_args
+
+    if workers > 1:
+        with concurrent.futures.ProcessPoolExecutor(workers) as executor:
+            pending = collections.deque()
+            for job in jobs():
+                if len(pending) >= 2 * workers:
+                    pending.popleft().result()
+                pending.append(executor.submit(_save_shard, job))
+            while pending:
+                pending.popleft().result()
+    else:
+        for job in jobs():
+            _save_shard(job)
+    with open(os.path.join(directory, "index.json"), "w") as f:
+        json.dump(index, f, indent=2)